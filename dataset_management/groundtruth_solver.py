@@ -1,41 +1,68 @@
-import numpy as np
+"""Ground truth solver.
+The ground truth of the TUM sequences is sampled by a motion capture system,
+not per video frame. This script resamples it at the timestamp of every frame
+of a sequence, interpolating positions linearly and orientations with slerp,
+and saves it as videos/{name}_groundtruth_interpolated.txt.
+
+Usage: python dataset_management/groundtruth_solver.py [names...]
+"""
+
+import argparse
+import glob
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from settings import VIDEO_NAME
-# So the dataset we are using is somewhat annoying. The ground truth is not
-# given per frame, but per second. So we need to interpolate the ground truth
-# between the seconds. We do this by picking the nearest neighbor ground truth
-# for each frame.
-GROUNDTRUTH_FILE_PATH = f"dataset_management/{VIDEO_NAME}_groundtruth.txt"
-FRAME_DATA_FILE_PATH = f"dataset_management/{VIDEO_NAME}_rgb.txt"
-
-# Load the groundtruth file:
-with open(GROUNDTRUTH_FILE_PATH, 'r') as f:
-    lines = f.readlines()
-    lines = [line.strip().split() for line in lines]
-    lines = lines[3:]
-    lines = [[float(x) for x in line] for line in lines]
-    # round to 6 decimal places
-    lines = [[round(x, 6) for x in line] for line in lines]
-    lines = np.array(lines)
-
-# Load the frame data file:
-with open(FRAME_DATA_FILE_PATH, 'r') as f:
-    lines2 = f.readlines()
-    lines2 = [line.strip().split() for line in lines2]
-    lines2 = lines2[3:]
-    lines2 = [float(line[0]) for line in lines2]
-    lines2 = np.array(lines2)
-
-# Interpolate the ground truth for each frame:
-groundtruth = []
-groundtruth_index = 0
-for i in range(len(lines2)):
-    while lines2[i] > lines[groundtruth_index][0]:
-        groundtruth_index += 1
-    groundtruth.append(lines[groundtruth_index])
-groundtruth = np.array(groundtruth)
-
-# Save the interpolated ground truth:
-np.savetxt(f"videos/{VIDEO_NAME}_groundtruth_interpolated.txt", groundtruth)
+import numpy as np
+from trajectory import load_trajectory, interpolate_trajectory, save_trajectory
+
+DATASET_DIRECTORY = "dataset_management"
+OUTPUT_DIRECTORY = "videos"
+
+
+def read_frame_stamps(filename):
+    """Read the timestamps of a TUM rgb.txt file, one "timestamp filename" line per frame.
+    Lines starting with # are comments.
+    """
+    with open(filename, 'r') as f:
+        lines = [line for line in f.read().splitlines() if line.strip() and not line.startswith('#')]
+    return np.array([line.split(None, 1)[0] for line in lines], dtype=np.float64)
+
+
+def find_sequences(directory=DATASET_DIRECTORY):
+    """Get the names of the sequences in a directory that have both ground truth and frame timestamps."""
+    names = [os.path.basename(path)[:-len('_groundtruth.txt')]
+             for path in glob.glob(os.path.join(directory, '*_groundtruth.txt'))]
+    return sorted(name for name in names if os.path.exists(os.path.join(directory, f'{name}_rgb.txt')))
+
+
+def solve_sequence(name, directory=DATASET_DIRECTORY, output_directory=OUTPUT_DIRECTORY):
+    """Resample the ground truth of a sequence at its frame timestamps.
+    Args
+        name: The name of the sequence, e.g. desk_1.
+        directory: The directory with {name}_groundtruth.txt and {name}_rgb.txt.
+        output_directory: The directory to save {name}_groundtruth_interpolated.txt in.
+
+    Returns
+    -------
+        The path of the saved file.
+    """
+    groundtruth = load_trajectory(os.path.join(directory, f'{name}_groundtruth.txt'))
+    groundtruth = groundtruth[np.argsort(groundtruth['stamp'], kind='stable')]
+    stamps = read_frame_stamps(os.path.join(directory, f'{name}_rgb.txt'))
+    path = os.path.join(output_directory, f'{name}_groundtruth_interpolated.txt')
+    save_trajectory(path, interpolate_trajectory(groundtruth, stamps))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resample the ground truth of TUM sequences at their frame timestamps.')
+    parser.add_argument('names', nargs='*', help='sequences to solve (default: every sequence in the directory)')
+    parser.add_argument('--directory', default=DATASET_DIRECTORY, help='directory with the ground truth and rgb.txt files')
+    parser.add_argument('--output', default=OUTPUT_DIRECTORY, help='directory to save the interpolated ground truth in')
+    args = parser.parse_args()
+
+    for name in args.names or find_sequences(args.directory):
+        print(solve_sequence(name, args.directory, args.output))
+
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+This script computes the absolute trajectory error between a ground truth
+trajectory and an estimated one, after aligning the estimate to the ground
+truth with a similarity transform. Monocular estimates have an arbitrary
+scale, so the scale is solved for as well unless --no_scale is given.
+
+Usage:
+    python evaluate_ate.py groundtruth_file estimated_file
+    python evaluate_ate.py --video_file desk_1
+    python evaluate_ate.py --all
+"""
+
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+
+from trajectory import load_trajectory, StampIndex
+
+# The largest time difference between associated poses, as in the TUM tools
+MAX_TIME_DIFFERENCE = 0.02
+
+
+def associate(stamps_gt, stamps_est, offset=0.0, max_difference=MAX_TIME_DIFFERENCE):
+    """Associate every estimated pose with the closest ground truth pose.
+    Args
+        stamps_gt: Sorted timestamps of the ground truth.
+        stamps_est: Timestamps of the estimate.
+        offset: Added to the estimated timestamps before they are associated.
+        max_difference: The largest time difference of an association.
+
+    Returns
+    -------
+        The indices of the associated ground truth and estimated poses.
+    """
+    indices_gt, matched = StampIndex(stamps_gt).associate(stamps_est, offset, max_difference)
+    return indices_gt[matched], np.flatnonzero(matched)
+
+
+def umeyama_alignment(model, data, with_scale=True):
+    """Find the similarity transform that best maps data onto model.
+    Solves min sum |model_i - (s R data_i + t)|^2 in closed form with a
+    single SVD (Umeyama, 1991).
+    Args
+        model: (N, 3) array of points to align to.
+        data: (N, 3) array of points to align.
+        with_scale: Whether to solve for the scale, or keep it at 1.
+
+    Returns
+    -------
+        The rotation R (3x3), translation t (3,) and scale s.
+    """
+    mean_model = model.mean(axis=0)
+    mean_data = data.mean(axis=0)
+    model_centered = model - mean_model
+    data_centered = data - mean_data
+
+    covariance = model_centered.T @ data_centered / len(model)
+    U, D, Vt = np.linalg.svd(covariance)
+    # Make sure R is a rotation and not a reflection
+    S = np.identity(3)
+    if np.linalg.det(U) * np.linalg.det(Vt) < 0:
+        S[2, 2] = -1
+    R = U @ S @ Vt
+    variance = np.mean(np.sum(data_centered ** 2, axis=1))
+    s = np.trace(np.diag(D) @ S) / variance if with_scale and variance > 0 else 1.0
+    t = mean_model - s * R @ mean_data
+    return R, t, s
+
+
+def evaluate_trajectory(trajectory_gt, trajectory_est, offset=0.0, max_difference=MAX_TIME_DIFFERENCE, with_scale=True):
+    """Compute the absolute trajectory error of an estimated trajectory.
+    Args
+        trajectory_gt: The ground truth, a structured array of TRAJECTORY_DTYPE.
+        trajectory_est: The estimate, a structured array of TRAJECTORY_DTYPE.
+        offset: Time offset between the trajectories (to model the delay).
+        max_difference: The largest time difference of associated poses.
+        with_scale: Whether to solve for the scale of the estimate.
+
+    Returns
+    -------
+        A dict with the per-pose errors, their statistics, and the
+        rotation, translation and scale that align the estimate.
+    """
+    trajectory_gt = trajectory_gt[np.argsort(trajectory_gt['stamp'], kind='stable')]
+    indices_gt, indices_est = associate(trajectory_gt['stamp'], trajectory_est['stamp'], offset, max_difference)
+    if len(indices_est) < 3:
+        raise Exception("Couldn't find matching timestamp pairs between groundtruth and estimated trajectory!")
+
+    model = trajectory_gt['position'][indices_gt]
+    data = trajectory_est['position'][indices_est]
+    R, t, s = umeyama_alignment(model, data, with_scale)
+    errors = np.linalg.norm(model - (s * data @ R.T + t), axis=1)
+    return {
+        'pairs': len(errors),
+        'rmse': np.sqrt(np.mean(errors ** 2)),
+        'mean': np.mean(errors),
+        'median': np.median(errors),
+        'std': np.std(errors),
+        'min': np.min(errors),
+        'max': np.max(errors),
+        'errors': errors,
+        'stamps': trajectory_est['stamp'][indices_est],
+        'rotation': R,
+        'translation': t,
+        'scale': s,
+    }
+
+
+def evaluate_videos(directory="videos", offset=0.0, max_difference=MAX_TIME_DIFFERENCE, with_scale=True):
+    """Compute the absolute trajectory error of every predicted trajectory in a directory.
+    Every {name}_predicted.txt is compared with {name}_groundtruth_interpolated.txt.
+    Returns
+    -------
+        A dict from the name of each video to the result of evaluate_trajectory().
+    """
+    results = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*_predicted.txt'))):
+        name = os.path.basename(path)[:-len('_predicted.txt')]
+        groundtruth_path = os.path.join(directory, f'{name}_groundtruth_interpolated.txt')
+        if not os.path.exists(groundtruth_path):
+            continue
+        results[name] = evaluate_trajectory(load_trajectory(groundtruth_path), load_trajectory(path),
+                                            offset, max_difference, with_scale)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the absolute trajectory error of an estimated trajectory.')
+    parser.add_argument('groundtruth_file', nargs='?', help='ground-truth trajectory file (format: "timestamp tx ty tz qx qy qz qw")')
+    parser.add_argument('estimated_file', nargs='?', help='estimated trajectory file (format: "timestamp tx ty tz qx qy qz qw")')
+    parser.add_argument('--video_file', help='evaluate videos/{video_file}_predicted.txt against its ground truth')
+    parser.add_argument('--all', help='evaluate every videos/*_predicted.txt against its ground truth', action='store_true')
+    parser.add_argument('--offset', help='time offset added to the estimated timestamps (default: 0.0)', type=float, default=0.0)
+    parser.add_argument('--max_difference', help='maximally allowed time difference for matching entries (default: 0.02)', type=float, default=MAX_TIME_DIFFERENCE)
+    parser.add_argument('--no_scale', help='only align with a rigid transform, for estimates with a known scale', action='store_true')
+    parser.add_argument('--verbose', help='print all statistics (otherwise, only the RMSE in meters is printed)', action='store_true')
+    args = parser.parse_args()
+
+    if args.all:
+        results = evaluate_videos(offset=args.offset, max_difference=args.max_difference, with_scale=not args.no_scale)
+    else:
+        if args.video_file:
+            args.groundtruth_file = f"./videos/{args.video_file}_groundtruth_interpolated.txt"
+            args.estimated_file = f"./videos/{args.video_file}_predicted.txt"
+        if not (args.groundtruth_file and args.estimated_file):
+            sys.exit("Give a ground-truth and an estimated trajectory file, --video_file or --all")
+        results = {args.estimated_file: evaluate_trajectory(load_trajectory(args.groundtruth_file),
+                                                            load_trajectory(args.estimated_file),
+                                                            args.offset, args.max_difference, not args.no_scale)}
+
+    for name, result in results.items():
+        if args.verbose:
+            print(name)
+            print("compared_pose_pairs %d pairs" % result['pairs'])
+            print("alignment_scale %f" % result['scale'])
+            for statistic in ('rmse', 'mean', 'median', 'std', 'min', 'max'):
+                print("absolute_translational_error.%s %f m" % (statistic, result[statistic]))
+        elif len(results) > 1:
+            print("%s %f" % (name, result['rmse']))
+        else:
+            print(result['rmse'])
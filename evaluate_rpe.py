@@ -40,7 +40,8 @@ import argparse
 import random
 import numpy
 import sys
-from matplotlib import pyplot as plt
+
+from trajectory import load_trajectory, trajectory_matrices, StampIndex
 
 _EPS = numpy.finfo(float).eps * 4.0
 
@@ -74,38 +75,24 @@ def transform44(l):
         (                0.0,                 0.0,                 0.0, 1.0)
         ), dtype=numpy.float64)
 
-def read_trajectory(filename, matrix=True):
+def read_trajectory(filename, matrix=True, cache=False):
     """
     Read a trajectory from a text file. 
     
     Input:
     filename -- file to be read
     matrix -- convert poses to 4x4 matrices
+    cache -- keep a binary copy of the parsed file for later reads
     
     Output:
     dictionary of stamped 3D poses
     """
-    file = open(filename)
-    data = file.read()
-    lines = data.replace(","," ").replace("\t"," ").split("\n") 
-    list = [[float(v.strip()) for v in line.split(" ") if v.strip()!=""] for line in lines if len(line)>0 and line[0]!="#"]
-    list_ok = []
-    for i,l in enumerate(list):
-        if l[4:8]==[0,0,0,0]:
-            continue
-        isnan = False
-        for v in l:
-            if numpy.isnan(v): 
-                isnan = True
-                break
-        if isnan:
-            sys.stderr.write("Warning: line %d of file '%s' has NaNs, skipping line\n"%(i,filename))
-            continue
-        list_ok.append(l)
+    trajectory = load_trajectory(filename, cache)
+    stamps = trajectory['stamp'].tolist()
     if matrix :
-      traj = dict([(l[0],transform44(l[0:])) for l in list_ok])
+      traj = dict(zip(stamps,trajectory_matrices(trajectory)))
     else:
-      traj = dict([(l[0],l[1:8]) for l in list_ok])
+      traj = dict(zip(stamps,numpy.concatenate((trajectory['position'],trajectory['orientation']),axis=1).tolist()))
     return traj
 
 def find_closest_index(L,t):
@@ -149,6 +136,36 @@ def ominus(a,b):
     """
     return numpy.dot(numpy.linalg.inv(a),b)
 
+def invert_transforms(a):
+    """
+    Invert a stack of rigid-body transformations in closed form.
+    
+    Input:
+    a -- stack of homogeneous 4x4 matrices with orthonormal rotations (N,4,4)
+    
+    Output:
+    stack of the inverse transformations (N,4,4)
+    """
+    rotation = numpy.swapaxes(a[:,0:3,0:3],1,2)
+    inverse = numpy.zeros_like(a)
+    inverse[:,0:3,0:3] = rotation
+    inverse[:,0:3,3] = -numpy.einsum('nij,nj->ni',rotation,a[:,0:3,3])
+    inverse[:,3,3] = 1
+    return inverse
+
+def ominus_stacked(a,b):
+    """
+    Compute the relative 3D transformations between two stacks of poses.
+    
+    Input:
+    a -- first poses (N,4,4)
+    b -- second poses (N,4,4)
+    
+    Output:
+    Relative 3D transformations from a to b (N,4,4).
+    """
+    return numpy.einsum('nij,njk->nik',invert_transforms(a),b)
+
 def scale(a,scalar):
     """
     Scale the translational components of a 4x4 homogeneous matrix by a scale factor.
@@ -173,36 +190,51 @@ def compute_angle(transform):
     # an invitation to 3-d vision, p 27
     return numpy.arccos( min(1,max(-1, (numpy.trace(transform[0:3,0:3]) - 1)/2) ))
 
+def compute_distances(transforms):
+    """
+    Compute the distances of the translational components of a stack of 4x4 homogeneous matrices.
+    """
+    return numpy.linalg.norm(transforms[:,0:3,3],axis=1)
+
+def compute_angles(transforms):
+    """
+    Compute the rotation angles of a stack of 4x4 homogeneous matrices.
+    """
+    traces = numpy.einsum('nii->n',transforms[:,0:3,0:3])
+    return numpy.arccos(numpy.clip((traces - 1)/2,-1,1))
+
+def stack_trajectory(traj):
+    """
+    Stack the poses of a trajectory in the order of their timestamps.
+    
+    Input:
+    traj -- dictionary of stamped 4x4 poses
+    
+    Output:
+    stamps -- sorted timestamps (N)
+    poses -- poses at those timestamps (N,4,4)
+    """
+    stamps = sorted(traj.keys())
+    return numpy.array(stamps,dtype=numpy.float64), numpy.array([traj[t] for t in stamps]).reshape(-1,4,4)
+
 def distances_along_trajectory(traj):
     """
     Compute the translational distances along a trajectory. 
     """
-    keys = list(traj.keys())
-    keys.sort()
-    motion = [ominus(traj[keys[i+1]],traj[keys[i]]) for i in range(len(keys)-1)]
-    distances = [0]
-    sum = 0
-    for t in motion:
-        sum += compute_distance(t)
-        distances.append(sum)
-    return distances
+    _, poses = stack_trajectory(traj)
+    motion = ominus_stacked(poses[1:],poses[:-1])
+    return numpy.concatenate(([0],numpy.cumsum(compute_distances(motion))))
     
 def rotations_along_trajectory(traj,scale):
     """
     Compute the angular rotations along a trajectory. 
     """
-    keys = list(traj.keys())
-    keys.sort()
-    motion = [ominus(traj[keys[i+1]],traj[keys[i]]) for i in range(len(keys)-1)]
-    distances = [0]
-    sum = 0
-    for t in motion:
-        sum += compute_angle(t)*scale
-        distances.append(sum)
-    return distances
+    _, poses = stack_trajectory(traj)
+    motion = ominus_stacked(poses[1:],poses[:-1])
+    return numpy.concatenate(([0],numpy.cumsum(compute_angles(motion)*scale)))
     
 
-def evaluate_trajectory(traj_gt,traj_est,param_max_pairs=10000,param_fixed_delta=False,param_delta=1.00,param_delta_unit="s",param_offset=0.00,param_scale=1.00):
+def evaluate_trajectory(traj_gt,traj_est,param_max_pairs=10000,param_fixed_delta=False,param_delta=1.00,param_delta_unit="s",param_offset=0.00,param_scale=1.00,param_chunk_size=100000):
     """
     Compute the relative pose error between two trajectories.
     
@@ -221,76 +253,64 @@ def evaluate_trajectory(traj_gt,traj_est,param_max_pairs=10000,param_fixed_delta
                         "f": frames
     param_offset -- time offset between two trajectories (to model the delay)
     param_scale -- scale to be applied to the second trajectory
+    param_chunk_size -- number of pairs evaluated at once, bounds the memory use
     
     Output:
-    list of compared poses and the resulting translation and rotation error
+    array with a row per compared pose pair: stamp_est0 stamp_est1 stamp_gt0 stamp_gt1 trans_error rot_error
     """
-    stamps_gt = list(traj_gt.keys())
-    stamps_est = list(traj_est.keys())
-    stamps_gt.sort()
-    stamps_est.sort()
+    stamps_gt, poses_gt = stack_trajectory(traj_gt)
+    stamps_est, poses_est = stack_trajectory(traj_est)
     
-    stamps_est_return = []
-    for t_est in stamps_est:
-        t_gt = stamps_gt[find_closest_index(stamps_gt,t_est + param_offset)]
-        t_est_return = stamps_est[find_closest_index(stamps_est,t_gt - param_offset)]
-        t_gt_return = stamps_gt[find_closest_index(stamps_gt,t_est_return + param_offset)]
-        if not t_est_return in stamps_est_return:
-            stamps_est_return.append(t_est_return)
+    index_gt = StampIndex(stamps_gt)
+    index_est = StampIndex(stamps_est)
+    t_gt = stamps_gt[index_gt.nearest(stamps_est,param_offset)]
+    stamps_est_return = numpy.unique(stamps_est[index_est.nearest(t_gt,-param_offset)])
     if(len(stamps_est_return)<2):
         raise Exception("Number of overlap in the timestamps is too small. Did you run the evaluation on the right files?")
 
     if param_delta_unit=="s":
-        index_est = list(traj_est.keys())
-        index_est.sort()
+        delta_index = index_est
     elif param_delta_unit=="m":
-        index_est = distances_along_trajectory(traj_est)
+        delta_index = StampIndex(distances_along_trajectory(traj_est))
     elif param_delta_unit=="rad":
-        index_est = rotations_along_trajectory(traj_est,1)
+        delta_index = StampIndex(rotations_along_trajectory(traj_est,1))
     elif param_delta_unit=="deg":
-        index_est = rotations_along_trajectory(traj_est,180/numpy.pi)
+        delta_index = StampIndex(rotations_along_trajectory(traj_est,180/numpy.pi))
     elif param_delta_unit=="f":
-        index_est = list(range(len(traj_est)))
+        delta_index = StampIndex(numpy.arange(len(traj_est)))
     else:
         raise Exception("Unknown unit for delta: '%s'"%param_delta_unit)
 
     if not param_fixed_delta:
         if(param_max_pairs==0 or len(traj_est)<numpy.sqrt(param_max_pairs)):
-            pairs = [(i,j) for i in range(len(traj_est)) for j in range(len(traj_est))]
+            pairs = numpy.indices((len(traj_est),len(traj_est))).reshape(2,-1).T
         else:
-            pairs = [(random.randint(0,len(traj_est)-1),random.randint(0,len(traj_est)-1)) for i in range(param_max_pairs)]
+            pairs = numpy.array([(random.randint(0,len(traj_est)-1),random.randint(0,len(traj_est)-1)) for i in range(param_max_pairs)])
     else:
-        pairs = []
-        for i in range(len(traj_est)):
-            j = find_closest_index(index_est,index_est[i] + param_delta)
-            if j!=len(traj_est)-1: 
-                pairs.append((i,j))
+        j = delta_index.nearest(delta_index.stamps,param_delta)
+        pairs = numpy.stack((numpy.arange(len(traj_est)),j),axis=1)[j!=len(traj_est)-1]
         if(param_max_pairs!=0 and len(pairs)>param_max_pairs):
-            pairs = random.sample(pairs,param_max_pairs)
+            pairs = numpy.array(random.sample([tuple(pair) for pair in pairs],param_max_pairs))
+    pairs = pairs.reshape(-1,2)
     
-    gt_interval = numpy.median([s-t for s,t in zip(stamps_gt[1:],stamps_gt[:-1])])
+    gt_interval = numpy.median(stamps_gt[1:] - stamps_gt[:-1])
     gt_max_time_difference = 2*gt_interval
     
-    result = []
-    for i,j in pairs:
-        stamp_est_0 = stamps_est[i]
-        stamp_est_1 = stamps_est[j]
-
-        stamp_gt_0 = stamps_gt[ find_closest_index(stamps_gt,stamp_est_0 + param_offset) ]
-        stamp_gt_1 = stamps_gt[ find_closest_index(stamps_gt,stamp_est_1 + param_offset) ]
-        
-        if(abs(stamp_gt_0 - (stamp_est_0 + param_offset)) > gt_max_time_difference  or
-           abs(stamp_gt_1 - (stamp_est_1 + param_offset)) > gt_max_time_difference):
-            continue
-        
-        error44 = ominus(  scale(
-                           ominus( traj_est[stamp_est_1], traj_est[stamp_est_0] ),param_scale),
-                           ominus( traj_gt[stamp_gt_1], traj_gt[stamp_gt_0] ) )
+    # Associate every estimated pose with its closest ground-truth pose once
+    closest_gt, matched = index_gt.associate(stamps_est,param_offset,gt_max_time_difference)
+    pairs = pairs[matched[pairs[:,0]] & matched[pairs[:,1]]]
+    
+    result = numpy.zeros((len(pairs),6))
+    for start in range(0,len(pairs),param_chunk_size):
+        i,j = pairs[start:start+param_chunk_size].T
+        gt_0,gt_1 = closest_gt[i],closest_gt[j]
         
-        trans = compute_distance(error44)
-        rot = compute_angle(error44)
+        motion_est = ominus_stacked(poses_est[j],poses_est[i])
+        motion_est[:,0:3,3] *= param_scale
+        error44 = ominus_stacked(motion_est,ominus_stacked(poses_gt[gt_1],poses_gt[gt_0]))
         
-        result.append([stamp_est_0,stamp_est_1,stamp_gt_0,stamp_gt_1,trans,rot])
+        result[start:start+param_chunk_size] = numpy.stack((stamps_est[i],stamps_est[j],stamps_gt[gt_0],stamps_gt[gt_1],
+                                                            compute_distances(error44),compute_angles(error44)),axis=1)
         
     if len(result)<2:
         raise Exception("Couldn't find matching timestamp pairs between groundtruth and estimated trajectory!")
@@ -322,6 +342,7 @@ if __name__ == '__main__':
     parser.add_argument('--save', help='text file to which the evaluation will be saved (format: stamp_est0 stamp_est1 stamp_gt0 stamp_gt1 trans_error rot_error)')
     parser.add_argument('--plot', help='plot the result to a file (requires --fixed_delta, output format: png)')
     parser.add_argument('--video_file')
+    parser.add_argument('--cache', help='keep binary copies of the trajectory files next to them for faster repeated evaluations', action='store_true')
     parser.add_argument('--verbose', help='print all evaluation data (otherwise, only the mean translational error measured in meters will be printed)', action='store_true')
     args = parser.parse_args()
     
@@ -332,8 +353,8 @@ if __name__ == '__main__':
         args.groundtruth_file = f"./videos/{args.video_file}_groundtruth_interpolated.txt"
         args.estimated_file = f"./videos/{args.video_file}_predicted.txt"
 
-    traj_gt = read_trajectory(args.groundtruth_file)
-    traj_est = read_trajectory(args.estimated_file)
+    traj_gt = read_trajectory(args.groundtruth_file, cache=args.cache)
+    traj_est = read_trajectory(args.estimated_file, cache=args.cache)
     
     result = evaluate_trajectory(traj_gt,
                                  traj_est,
@@ -5,59 +5,85 @@ extrinsic parameters of the camera (pose).
 
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
+
+from features import create_tracker
+import instrument
 
 last_magnitude = 0.1
-def calibrate(image1, image2, focal_length=300.0, principal_point=(400.0, 300.0), last_frame_points3D=np.zeros(0), last_frame_matches=np.zeros(0)):
+default_tracker = None
+
+def find_essential_matrix(points1, points2, focal_length, principal_point, frame_index=None):
+    """Estimate the essential matrix of two sets of corresponding points with RANSAC.
+    The share of the points that RANSAC kept as inliers is recorded by the
+    instrument module, for the frame frame_index.
+    Returns
+    -------
+        The 3x3 essential matrix, or None if it could not be estimated.
+    """
+    E, mask = cv2.findEssentialMat(points1, points2, focal_length, principal_point, cv2.RANSAC, 0.999, 1.0)
+    if mask is not None:
+        instrument.counter('inlier_ratio', float(np.count_nonzero(mask)) / len(mask), frame_index)
+    if E is None:
+        return None
+    # Degenerate configurations can give several stacked solutions, use the first
+    return E[:3]
+
+def recover_pose(E, points1, points2, focal_length, principal_point):
+    """Decompose an essential matrix into the rotation and translation between two views.
+    Returns
+    -------
+        The rotation matrix and the unit translation vector.
+    """
+    retval, R, t, mask = cv2.recoverPose(E, points1, points2, focal=focal_length, pp=principal_point)
+    return R, t
+
+def calibrate(image1, image2, focal_length=300.0, principal_point=(400.0, 300.0), last_frame_points3D=np.zeros(0), last_frame_matches=np.zeros(0), tracker=None, frame_indices=(None, None)):
     """Determine the position and orientation difference between two images.
     Args
         image1: The first image.
         image2: The second image.
         last_frame_points3D: the 3D points triangulated from the last pair of images
+        tracker: The FeatureTracker or OpticalFlowTracker that finds the
+            correspondences. A shared module-level tracker is used if None.
+        frame_indices: The frame numbers of image1 and image2, used by the
+            tracker to recognize frames it has already seen.
 
     Returns
     -------
         The rotation and translation between the two images.
     """
-    global last_magnitude
-    image1 = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
-    image2 = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
-    # Flip the images
-    image1 = cv2.flip(image1, 0)
-    image2 = cv2.flip(image2, 0)
-
-    # 1. Find the keypoints and descriptors of image1.
-    sift = cv2.SIFT_create()
-    kp1, des1 = sift.detectAndCompute(image1, None)
-
-    # 2. Find the keypoints and descriptors of image2.
-    kp2, des2 = sift.detectAndCompute(image2, None)
-
-    # 3. Match the descriptors of image1 and image2.
-    bf = cv2.BFMatcher()
-    matches = bf.knnMatch(des1,des2,k=2)
-
-    # Apply ratio test
-    good = []
-    for m,n in matches:
-        if m.distance < 0.75*n.distance:
-            good.append([m])
-    
-    if len(good) < 4:
-        return np.identity(3), np.zeros((3, 1))
+    global last_magnitude, default_tracker
+    if tracker is None:
+        if default_tracker is None:
+            default_tracker = create_tracker()
+        tracker = default_tracker
+
+    # 1-4. Find the corresponding points of image1 and image2.
+    with instrument.span('correspondences', frame=frame_indices[1]):
+        points1, points2, good = tracker.correspondences(image1, image2, frame_indices)
+    instrument.counter('good_matches', len(points1), frame_indices[1])
+
+    # The points can be found on a smaller copy of the frames, so scale the
+    # camera to match
+    scale = tracker.scale
+    focal_length = focal_length * scale
+    principal_point = (principal_point[0] * scale, principal_point[1] * scale)
+
+    # The five point algorithm needs at least five correspondences
+    if len(points1) < 5:
+        return np.identity(3), np.zeros((3, 1)), last_frame_points3D, good
 
-    # 4. Find the fundamental matrix from the matches.
-    # decompose the matches into their respective points
-    points1 = np.float32([kp1[m[0].queryIdx].pt for m in good])
-    points2 = np.float32([kp2[m[0].trainIdx].pt for m in good])
-    
     intrinsic_matrix = np.array([[focal_length, 0, principal_point[0]],
                                  [0, focal_length, principal_point[1]],
                                  [0, 0, 1]])
     
-    E = cv2.findEssentialMat(points1, points2, focal_length, principal_point, cv2.RANSAC, 0.999, 1.0)[0]
+    with instrument.span('essential', frame=frame_indices[1]):
+        E = find_essential_matrix(points1, points2, focal_length, principal_point, frame_indices[1])
+    if E is None:
+        return np.identity(3), np.zeros((3, 1)), last_frame_points3D, good
 
-    retval, R, t, mask = cv2.recoverPose(E, points1, points2, focal=focal_length, pp=principal_point)
+    with instrument.span('recover_pose', frame=frame_indices[1]):
+        R, t = recover_pose(E, points1, points2, focal_length, principal_point)
 
     return R, t, last_frame_points3D, good
 
@@ -0,0 +1,467 @@
+"""Feature tracking module.
+This module finds corresponding points between video frames, either by
+matching keypoint descriptors or by following corners with optical flow.
+Features are kept around so that a frame that takes part in two consecutive
+image pairs only has to be processed once.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+from settings import (FEATURE_DETECTOR, FEATURE_MATCHER, MATCH_MUTUAL_CHECK, TRACKING_MODE,
+                      KLT_MAX_CORNERS, KLT_MIN_TRACKS, KLT_MAX_PARALLAX, FEATURE_MAX_WIDTH, FEATURE_REFINE,
+                      FEATURE_GRID, FEATURE_CELL_KEYPOINTS, FEATURE_MAX_KEYPOINTS,
+                      FEATURE_MIN_KEYPOINTS)
+import instrument
+
+# Feature detectors that can be selected with FEATURE_DETECTOR in settings.py
+DETECTORS = {
+    "SIFT": lambda: cv2.SIFT_create(),
+    "ORB": lambda: cv2.ORB_create(nfeatures=2000),
+    "AKAZE": lambda: cv2.AKAZE_create(),
+    "BRISK": lambda: cv2.BRISK_create(),
+}
+
+# The property of each detector that sets how strong a keypoint has to be
+DETECTOR_THRESHOLDS = {
+    "SIFT": "ContrastThreshold",
+    "ORB": "FastThreshold",
+    "AKAZE": "Threshold",
+    "BRISK": "Threshold",
+}
+
+# Detectors whose threshold accessors are missing from older OpenCV versions,
+# e.g. SIFT before 4.7, with their default threshold and a way to create one
+# with another threshold
+THRESHOLD_FALLBACKS = {
+    "SIFT": (0.04, lambda threshold: cv2.SIFT_create(contrastThreshold=threshold)),
+}
+
+# The number of times the threshold of a detector is halved on a frame with
+# too few keypoints
+THRESHOLD_STEPS = 3
+
+
+def _bf_matcher(binary):
+    return cv2.BFMatcher(cv2.NORM_HAMMING if binary else cv2.NORM_L2)
+
+
+def _flann_matcher(binary):
+    if binary:
+        # Locality sensitive hashing for binary descriptors
+        index_params = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)
+    else:
+        # Randomized KD-trees for float descriptors
+        index_params = dict(algorithm=1, trees=5)
+    return cv2.FlannBasedMatcher(index_params, dict(checks=50))
+
+
+# Descriptor matchers that can be selected with FEATURE_MATCHER in settings.py.
+# Each one is created from whether the descriptors are binary or not.
+MATCHERS = {
+    "BF": _bf_matcher,
+    "FLANN": _flann_matcher,
+}
+
+
+# The termination criteria of the sub-pixel refinement of points
+REFINE_CRITERIA = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.01)
+
+
+@dataclass
+class Features:
+    """The keypoints of a frame, their descriptors and their (N, 2) positions.
+    The positions are in the coordinates of the frame scaled by scale.
+    """
+    keypoints: tuple
+    descriptors: np.ndarray
+    points: np.ndarray
+    scale: float = 1.0
+
+
+def prepare_image(image, max_width=0):
+    """Convert a BGR frame to the flipped grayscale image used for features.
+    Args
+        image: The BGR frame.
+        max_width: Halve the image with cv2.pyrDown until it is at most this
+            many pixels wide. 0 keeps the full resolution.
+
+    Returns
+    -------
+        The grayscale image and its scale relative to the frame. A point p
+        in the image is at p / scale in the (flipped) frame.
+    """
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Flip the image
+    image = cv2.flip(image, 0)
+    scale = 1.0
+    while max_width and image.shape[1] > max_width:
+        image = cv2.pyrDown(image)
+        scale /= 2
+    return image, scale
+
+
+def bucket_keypoints(keypoints, shape, grid=FEATURE_GRID, per_cell=FEATURE_CELL_KEYPOINTS,
+                     max_keypoints=FEATURE_MAX_KEYPOINTS,
+                 min_keypoints=FEATURE_MIN_KEYPOINTS):
+    """Spread keypoints evenly over an image.
+    The image is split into a grid, and only the strongest keypoints of every
+    cell are kept. If more than max_keypoints remain, the strongest of every
+    cell are taken first, then the second strongest, and so on.
+    Args
+        keypoints: The keypoints from a detector.
+        shape: The shape of the image the keypoints were found on.
+        grid: The number of (columns, rows) of the grid.
+        per_cell: The largest number of keypoints kept in a cell.
+        max_keypoints: The largest number of keypoints kept in total.
+
+    Returns
+    -------
+        The kept keypoints, as a tuple.
+    """
+    if len(keypoints) == 0:
+        return tuple(keypoints)
+    points = cv2.KeyPoint_convert(keypoints).reshape(-1, 2)
+    responses = np.array([keypoint.response for keypoint in keypoints])
+    columns, rows = grid
+    height, width = shape[:2]
+    cells = (np.clip((points[:, 1] * rows / height).astype(np.intp), 0, rows - 1) * columns
+             + np.clip((points[:, 0] * columns / width).astype(np.intp), 0, columns - 1))
+
+    # Rank the keypoints of every cell from strongest to weakest
+    order = np.lexsort((-responses, cells))
+    sorted_cells = cells[order]
+    ranks = np.empty(len(order), np.intp)
+    ranks[order] = np.arange(len(order)) - np.searchsorted(sorted_cells, sorted_cells)
+    kept = np.flatnonzero(ranks < per_cell)
+    if max_keypoints and len(kept) > max_keypoints:
+        kept = kept[np.lexsort((-responses[kept], ranks[kept]))[:max_keypoints]]
+    return tuple(keypoints[i] for i in kept)
+
+
+def refine_points(image, points, scale):
+    """Move points found on a smaller copy of a frame to sub-pixel corner positions in the frame.
+    Args
+        image: The full resolution grayscale image from prepare_image().
+        points: (N, 2) array of points in the image scaled by scale.
+        scale: The scale of the points.
+
+    Returns
+    -------
+        (N, 2) array of the refined points in the full resolution image.
+    """
+    points = np.asarray(points / scale, np.float32).reshape(-1, 2)
+    # Tracks can drift off the image, and those are left as they are
+    height, width = image.shape[:2]
+    inside = ((points >= 0) & (points <= (width - 1, height - 1))).all(axis=1)
+    if inside.any():
+        window = max(int(round(1 / scale)), 2) + 1
+        corners = np.ascontiguousarray(points[inside]).reshape(-1, 1, 2)
+        points[inside] = cv2.cornerSubPix(image, corners, (window, window), (-1, -1), REFINE_CRITERIA).reshape(-1, 2)
+    return points
+
+
+class FeatureTracker:
+    """Detects features with a long-lived detector and caches them per frame.
+    Args
+        capacity: The number of frames whose features are kept in the cache.
+        detector: Name of the feature detector in DETECTORS.
+        matcher: Name of the descriptor matcher in MATCHERS.
+        mutual_check: Only keep matches that also match the other way around.
+        max_width: Find features on a copy of the frames that is halved until
+            it is at most this many pixels wide, 0 for the full resolution.
+        refine: Refine the points at the full resolution of the frames.
+        max_keypoints: Keep at most this many keypoints per frame, spread
+            over a FEATURE_GRID. 0 keeps every keypoint.
+        min_keypoints: Lower the threshold of the detector on frames with
+            fewer keypoints than this, when max_keypoints is set.
+    """
+
+    def __init__(self, capacity=2, detector=FEATURE_DETECTOR, matcher=FEATURE_MATCHER, mutual_check=MATCH_MUTUAL_CHECK,
+                 max_width=FEATURE_MAX_WIDTH, refine=FEATURE_REFINE, max_keypoints=FEATURE_MAX_KEYPOINTS,
+                 min_keypoints=FEATURE_MIN_KEYPOINTS):
+        if detector not in DETECTORS:
+            raise ValueError(f"Unknown feature detector '{detector}', expected one of {list(DETECTORS)}")
+        if matcher not in MATCHERS:
+            raise ValueError(f"Unknown descriptor matcher '{matcher}', expected one of {list(MATCHERS)}")
+        self.detector = DETECTORS[detector]()
+        self.threshold_name = DETECTOR_THRESHOLDS[detector]
+        self._fallback = THRESHOLD_FALLBACKS.get(detector)
+        # None when the threshold of the detector cannot or need not be changed
+        self._default_threshold = self._get_threshold() if max_keypoints and min_keypoints else None
+        if max_keypoints and hasattr(self.detector, 'setMaxFeatures'):
+            # ORB keeps its own number of strongest keypoints, leave room to choose from
+            self.detector.setMaxFeatures(2 * max_keypoints)
+        self.max_keypoints = max_keypoints
+        self.min_keypoints = min_keypoints
+        binary = self.detector.descriptorType() == cv2.CV_8U
+        self.matcher = MATCHERS[matcher](binary)
+        self.mutual_check = mutual_check
+        self.max_width = max_width
+        self.refine = refine
+        # The scale of the points returned by the last call to correspondences()
+        self.scale = 1.0
+        self.capacity = capacity
+        self._cache = OrderedDict()
+
+    def describe(self, image, frame_index=None):
+        """Find the keypoints and descriptors of a frame.
+        Args
+            image: The BGR frame.
+            frame_index: Key of the frame in the cache. If None, the features
+                are computed without being cached.
+
+        Returns
+        -------
+            The Features of the frame.
+        """
+        if frame_index is not None and frame_index in self._cache:
+            return self._cache[frame_index]
+
+        with instrument.span('detect', frame=frame_index):
+            gray, scale = prepare_image(image, self.max_width)
+            if self.max_keypoints:
+                keypoints = self.detect(gray)
+                # Only describe the keypoints that are kept
+                keypoints, descriptors = self.detector.compute(gray, bucket_keypoints(keypoints, gray.shape,
+                                                                                      max_keypoints=self.max_keypoints))
+            else:
+                keypoints, descriptors = self.detector.detectAndCompute(gray, None)
+        # KeyPoint_convert returns an empty tuple for blank frames
+        points = cv2.KeyPoint_convert(keypoints).reshape(-1, 2) if keypoints else np.zeros((0, 2), np.float32)
+        features = Features(keypoints, descriptors, points, scale)
+        if self.refine and scale != 1.0:
+            with instrument.span('refine', frame=frame_index):
+                features.points = refine_points(prepare_image(image)[0], features.points, scale)
+            features.scale = 1.0
+        instrument.counter('keypoints', len(keypoints), frame_index)
+
+        if frame_index is not None:
+            self._cache[frame_index] = features
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+        return features
+
+    def _get_threshold(self):
+        """Get the default threshold of the detector, or None if it cannot be changed."""
+        getter = getattr(self.detector, 'get' + self.threshold_name, None)
+        if getter is not None:
+            return getter()
+        if self._fallback is not None:
+            return self._fallback[0]
+        return None
+
+    def _set_threshold(self, threshold):
+        """Set the threshold of the detector.
+        Args
+            threshold: The new threshold.
+
+        Returns
+        -------
+            The detector to detect with, a new one if the detector has no setter.
+        """
+        setter = getattr(self.detector, 'set' + self.threshold_name, None)
+        if setter is not None:
+            setter(threshold)
+            return self.detector
+        return self._fallback[1](threshold)
+
+    def detect(self, gray):
+        """Detect keypoints, lowering the threshold of the detector on frames with too few.
+        Frames with at least min_keypoints keypoints are detected only once.
+        Every frame starts from the default threshold, so the keypoints of a
+        frame do not depend on the frames that were detected before it.
+        Args
+            gray: The image from prepare_image().
+
+        Returns
+        -------
+            The keypoints of the image.
+        """
+        keypoints = self.detector.detect(gray, None)
+        if self._default_threshold is None or len(keypoints) >= self.min_keypoints:
+            return keypoints
+
+        threshold = self._default_threshold
+        try:
+            for step in range(THRESHOLD_STEPS):
+                threshold /= 2
+                if isinstance(self._default_threshold, int):
+                    # FAST thresholds are whole intensity levels
+                    threshold = max(int(threshold), 1)
+                keypoints = self._set_threshold(threshold).detect(gray, None)
+                if len(keypoints) >= self.min_keypoints:
+                    break
+        finally:
+            self._set_threshold(self._default_threshold)
+        return keypoints
+
+    def match(self, des1, des2):
+        """Find the two nearest neighbours in des2 of every descriptor in des1.
+        Returns
+        -------
+            An (N, 2) array with the indices into des2 of the two neighbours of
+            every descriptor in des1, and an (N, 2) array of their distances.
+            Missing neighbours have index -1 and an infinite distance.
+        """
+        train = np.full((0 if des1 is None else len(des1), 2), -1, np.intp)
+        distance = np.full(train.shape, np.inf, np.float32)
+        if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
+            return train, distance
+
+        matches = self.matcher.knnMatch(des1, des2, k=2)
+        # Approximate matchers can return fewer than two neighbours
+        flat = np.array([(m.queryIdx, column, m.trainIdx, m.distance)
+                         for pair in matches for column, m in enumerate(pair[:2])]).reshape(-1, 4)
+        query, column = flat[:, 0].astype(np.intp), flat[:, 1].astype(np.intp)
+        train[query, column] = flat[:, 2]
+        distance[query, column] = flat[:, 3]
+        return train, distance
+
+    def correspondences(self, image1, image2, frame_indices=(None, None)):
+        """Find the matching points of two frames.
+        Args
+            image1: The first BGR frame.
+            image2: The second BGR frame.
+            frame_indices: The cache keys of image1 and image2.
+
+        Returns
+        -------
+            The matched points in image1 and image2, and the good matches as
+            an (N, 2) array of keypoint indices into image1 and image2. The
+            points are in the coordinates of the frames scaled by self.scale.
+        """
+        features1 = self.describe(image1, frame_indices[0])
+        features2 = self.describe(image2, frame_indices[1])
+        with instrument.span('match', frame=frame_indices[1]):
+            train, distance = self.match(features1.descriptors, features2.descriptors)
+
+        # Apply ratio test
+        query = np.flatnonzero(distance[:, 0] < 0.75*distance[:, 1])
+        train = train[query, 0]
+
+        if self.mutual_check and len(query) > 0:
+            # Keep the matches that are also the best match the other way around
+            backward, _ = self.match(features2.descriptors, features1.descriptors)
+            mutual = backward[train, 0] == query
+            query, train = query[mutual], train[mutual]
+
+        # decompose the matches into their respective points
+        good = np.stack((query, train), axis=1)
+        self.scale = features2.scale
+        return features1.points[query], features2.points[train], good
+
+    def clear(self):
+        """Forget all cached features."""
+        self._cache.clear()
+
+
+class OpticalFlowTracker:
+    """Tracks corners with pyramidal Lucas-Kanade optical flow.
+    Corners are only detected on keyframes. Between keyframes they are
+    followed from frame to frame, and a new keyframe is started once too few
+    tracks survive or the tracks have moved too far from the keyframe.
+    Args
+        max_corners: The number of corners detected on a keyframe.
+        min_tracks: Start a new keyframe when fewer tracks than this remain.
+        max_parallax: Start a new keyframe when the median track has moved
+            more than this many pixels since the keyframe.
+        max_width: Track on a copy of the frames that is halved until it is
+            at most this many pixels wide, 0 for the full resolution.
+        refine: Refine the points at the full resolution of the frames.
+    """
+
+    def __init__(self, max_corners=KLT_MAX_CORNERS, min_tracks=KLT_MIN_TRACKS, max_parallax=KLT_MAX_PARALLAX,
+                 max_width=FEATURE_MAX_WIDTH, refine=FEATURE_REFINE):
+        self.max_corners = max_corners
+        self.min_tracks = min_tracks
+        self.max_parallax = max_parallax
+        self.max_width = max_width
+        self.refine = refine
+        # The scale of the points returned by the last call to correspondences()
+        self.scale = 1.0
+        self.flow_params = dict(winSize=(21, 21), maxLevel=3,
+                                criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+        self.clear()
+
+    def needs_keyframe(self):
+        """Whether the current tracks are too few or too far from the keyframe."""
+        if self._points is None or len(self._points) < self.min_tracks:
+            return True
+        parallax = np.linalg.norm(self._points - self._keyframe_points, axis=1)
+        return np.median(parallax) > self.max_parallax
+
+    def correspondences(self, image1, image2, frame_indices=(None, None)):
+        """Track points from one frame to the next.
+        Args
+            image1: The first BGR frame.
+            image2: The second BGR frame.
+            frame_indices: The frame numbers of image1 and image2. The tracks
+                are only continued if image1 is the last frame seen.
+
+        Returns
+        -------
+            The tracked points in image1 and image2, and None for the matches.
+            The points are in the coordinates of the frames scaled by self.scale.
+        """
+        if frame_indices[0] is None or frame_indices[0] != self._frame_index:
+            # Not a continuation of the last call, so start from scratch
+            self.clear()
+            self._image, _ = prepare_image(image1, self.max_width)
+            if self.refine:
+                self._full_image, _ = prepare_image(image1)
+        if self.needs_keyframe():
+            with instrument.span('detect', frame=frame_indices[0]):
+                corners = cv2.goodFeaturesToTrack(self._image, self.max_corners, 0.01, 8)
+            self._points = np.zeros((0, 2), np.float32) if corners is None else corners.reshape(-1, 2)
+            self._keyframe_points = self._points.copy()
+            instrument.counter('keypoints', len(self._points), frame_indices[0])
+
+        gray2, scale = prepare_image(image2, self.max_width)
+        points1 = self._points
+        if len(points1) > 0:
+            with instrument.span('track', frame=frame_indices[1]):
+                points2, status, _ = cv2.calcOpticalFlowPyrLK(self._image, gray2, points1, None, **self.flow_params)
+                # Check the tracks by flowing them back to image1
+                points1_back, status_back, _ = cv2.calcOpticalFlowPyrLK(gray2, self._image, points2, None, **self.flow_params)
+            error = np.linalg.norm(points1 - points1_back, axis=1)
+            keep = (status.ravel() == 1) & (status_back.ravel() == 1) & (error < 1.0)
+            points1, points2 = points1[keep], points2[keep]
+            self._keyframe_points = self._keyframe_points[keep]
+        else:
+            points2 = points1
+
+        self._image = gray2
+        self._points = points2
+        self._frame_index = frame_indices[1]
+        self.scale = scale
+        if self.refine:
+            full_image2, _ = prepare_image(image2)
+            if scale != 1.0:
+                # The tracks themselves stay at the scale they are followed at
+                with instrument.span('refine', frame=frame_indices[1]):
+                    points1 = refine_points(self._full_image, points1, scale)
+                    points2 = refine_points(full_image2, points2, scale)
+                self.scale = 1.0
+            self._full_image = full_image2
+        return points1, points2, None
+
+    def clear(self):
+        """Forget all tracks."""
+        self._image = None
+        self._full_image = None
+        self._points = None
+        self._keyframe_points = None
+        self._frame_index = None
+
+
+def create_tracker(mode=TRACKING_MODE):
+    """Create the tracker for a TRACKING_MODE of "match" or "klt"."""
+    if mode == "match":
+        return FeatureTracker()
+    if mode == "klt":
+        return OpticalFlowTracker()
+    raise ValueError(f"Unknown tracking mode '{mode}', expected 'match' or 'klt'")
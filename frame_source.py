@@ -0,0 +1,108 @@
+"""Frame source module.
+This module streams decoded video frames straight out of ffmpeg, so that the
+pipeline never has to dump the whole video to images on disk.
+"""
+
+import ffmpeg
+import numpy as np
+
+import instrument
+
+
+def probe_video(video_path):
+    """Read the resolution and the frame count of a video.
+    Args
+        video_path: Path to the video file.
+
+    Returns
+    -------
+        The (width, height) of the video as an array, and its number of frames.
+    """
+    probe = ffmpeg.probe(video_path)
+    stream = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+    video_resolution = np.array((int(stream['width']), int(stream['height'])))
+    if 'nb_frames' in stream:
+        video_frame_count = int(stream['nb_frames'])
+    else:
+        # Some containers do not store the frame count, so estimate it
+        num, den = stream['avg_frame_rate'].split('/')
+        video_frame_count = int(float(probe['format']['duration']) * int(num) / int(den))
+    return video_resolution, video_frame_count
+
+
+def select_expression(frame_numbers):
+    """Build an ffmpeg select expression that passes exactly the given frames.
+    The frame numbers are split into runs with a constant step, so that a
+    regular schedule such as [5, 6, 8, 10, ...] stays a short expression.
+    Args
+        frame_numbers: Increasing frame numbers.
+
+    Returns
+    -------
+        The expression for the select filter.
+    """
+    terms = []
+    i = 0
+    while i < len(frame_numbers):
+        first = frame_numbers[i]
+        step = frame_numbers[i + 1] - first if i + 1 < len(frame_numbers) else 1
+        j = i + 1
+        while j < len(frame_numbers) and frame_numbers[j] - frame_numbers[j - 1] == step:
+            j += 1
+        last = frame_numbers[j - 1]
+        if first == last:
+            terms.append(f'eq(n,{first})')
+        elif step == 1:
+            terms.append(f'between(n,{first},{last})')
+        else:
+            terms.append(f'between(n,{first},{last})*not(mod(n-{first},{step}))')
+        i = j
+    return '+'.join(terms)
+
+
+def read_frames(video_path, frame_numbers, video_resolution=None):
+    """Decode the requested frames of a video.
+    The frames are piped from ffmpeg as raw BGR bytes and read one at a time,
+    so only a single frame is held in memory regardless of the video length.
+    Frames that are not requested are dropped inside ffmpeg, so they are
+    never converted or sent through the pipe.
+    Args
+        video_path: Path to the video file.
+        frame_numbers: Increasing frame numbers to decode, e.g. a range.
+        video_resolution: The (width, height) of the video, probed if None.
+
+    Yields
+    ------
+        Tuples of (frame_number, frame), where frame is an HxWx3 BGR image.
+    """
+    if video_resolution is None:
+        video_resolution, _ = probe_video(video_path)
+    width, height = (int(x) for x in video_resolution)
+    frame_size = width * height * 3
+
+    frame_numbers = list(frame_numbers)
+    if not frame_numbers:
+        return
+
+    process = (
+        ffmpeg.input(video_path)
+        .filter('select', select_expression(frame_numbers))
+        .output('pipe:', format='rawvideo', pix_fmt='bgr24', vsync=0)
+        .global_args('-loglevel', 'error')
+        .run_async(pipe_stdout=True)
+    )
+    try:
+        for frame_number in frame_numbers:
+            buffer = bytearray(frame_size)
+            with instrument.span('decode', frame=frame_number):
+                size = process.stdout.readinto(buffer)
+            if size < frame_size:
+                break
+            frame = np.frombuffer(buffer, np.uint8).reshape(height, width, 3)
+            yield frame_number, frame
+    finally:
+        # Kill ffmpeg before closing the pipe so that it does not complain
+        # about the frames that were never read
+        process.kill()
+        process.wait()
+        process.stdout.close()
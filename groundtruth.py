@@ -1,15 +1,13 @@
 """Reads a video along with ground-truth data and rasterizes the object in the video."""
 
-import os
-import shutil
-import ffmpeg
 import cv2
 import numpy as np
-import glfw
 import sys
 import math
 
 import rasterize
+from frame_source import probe_video, read_frames
+from trajectory import load_trajectory
 from settings import *
 
 def euler_from_quaternion(x, y, z, w):
@@ -33,51 +31,28 @@ def euler_from_quaternion(x, y, z, w):
 
 
 def main():
-    # clear the images folder
-    try:
-        shutil.rmtree(IMAGES_FOLDER)
-    except:
-        pass
-    os.mkdir(IMAGES_FOLDER)
-
-
-    # load the video frames into the images folder
-    ( ffmpeg.input(VIDEO_FILE_PATH)
-        # .filter('fps', fps='1/60')
-        .output(f'{IMAGES_FOLDER}/image%d.png',
-                start_number=0)
-        .overwrite_output()
-        .run()
-    )
-    video_resolution = ffmpeg.probe(VIDEO_FILE_PATH)['streams'][0]['width'], ffmpeg.probe(VIDEO_FILE_PATH)['streams'][0]['height']
-    video_resolution = np.array(video_resolution)
-    video_frame_count = int(ffmpeg.probe(VIDEO_FILE_PATH)['streams'][0]['nb_frames'])
-
-    # Read the ground-truth data
-    with open(GROUNDTRUTH_FILE_PATH, 'r') as f:
-        lines = f.readlines()
-        lines = [line.strip().split() for line in lines]
-        lines = [[float(x) for x in line] for line in lines]
-        lines = np.array(lines)
+    video_resolution, video_frame_count = probe_video(VIDEO_FILE_PATH)
+    frames = read_frames(VIDEO_FILE_PATH, range(0, video_frame_count, SKIP_FRAMES), video_resolution)
+
+    # Read the ground-truth data. It has a pose for every frame, so a skipped
+    # pose would shift every later frame onto the wrong one.
+    groundtruth = load_trajectory(GROUNDTRUTH_FILE_PATH, strict=True)
     
     # Initialize rasterizer module
     window, obj, clock, camera = rasterize.init(CAMERA_FOCAL_LENGTH, CAMERA_PRINCIPAL_POINT, video_resolution)
 
-    _, tx0, ty0, tz0, qx0, qy0, qz0, qw0 = lines[0]
+    tx0, ty0, tz0 = groundtruth['position'][0]
 
     # Draw the first frame
     line_number = 0
-    for frame_number in range(0, video_frame_count, SKIP_FRAMES):
+    for frame_number, image in frames:
         rasterize.handle_events(window)
-        # Load the next frame of the video
-        image = cv2.imread(f'{IMAGES_FOLDER}/image{frame_number}.png')
-        if image is None:
-            break
 
         # Resize image to fit the framebuffer
         image = cv2.resize(image, rasterize.buffer_size)
     
-        _, tx, ty, tz, qx, qy, qz, qw = lines[frame_number]
+        tx, ty, tz = groundtruth['position'][frame_number]
+        qx, qy, qz, qw = groundtruth['orientation'][frame_number]
         # Convert the quaternion to euler angles
         rx, ry, rz = euler_from_quaternion(qx, qy, qz, qw)
 
@@ -0,0 +1,150 @@
+"""Instrument module.
+This module records how long the stages of the pipeline take for every
+frame, along with counters such as the number of keypoints, and saves them
+as a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev)
+or as a CSV timeline.
+
+It is switched on by INSTRUMENT in settings.py, or by setting the
+PIPELINE_TRACE environment variable to the file to save the trace to. When
+it is off, span() hands out a shared object that does nothing, and
+counter() returns straight away.
+"""
+
+import csv
+import json
+import os
+import threading
+import time
+
+from settings import INSTRUMENT, INSTRUMENT_OUTPUT
+
+enabled = INSTRUMENT or bool(os.environ.get("PIPELINE_TRACE"))
+output_path = os.environ.get("PIPELINE_TRACE") or INSTRUMENT_OUTPUT
+
+# The recorded events, in the Chrome trace event format
+events = []
+# The names of the threads that recorded events, by thread ident. The stage
+# threads have finished by the time the events are saved.
+thread_names = {}
+_origin = time.perf_counter_ns()
+_pid = os.getpid()
+
+
+def _now():
+    # Chrome traces count microseconds
+    return (time.perf_counter_ns() - _origin) / 1000
+
+
+def _thread_ident():
+    """Get the ident of the current thread, and remember its name."""
+    ident = threading.get_ident()
+    if ident not in thread_names:
+        thread_names[ident] = threading.current_thread().name
+    return ident
+
+
+class _Span:
+    """Records the time spent inside a with block as a complete event."""
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = _now()
+        return self
+
+    def __exit__(self, *exc_info):
+        events.append({'name': self.name, 'ph': 'X', 'ts': self.start, 'dur': _now() - self.start,
+                       'pid': _pid, 'tid': _thread_ident(), 'args': self.args})
+        return False
+
+
+class _NullSpan:
+    """Stands in for _Span when instrumentation is off."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **args):
+    """Time a with block.
+    Args
+        name: The name of the stage, e.g. "detect".
+        args: Extra values stored with the span, e.g. frame=12.
+    """
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def counter(name, value, frame=None):
+    """Record the value of a counter, e.g. the number of keypoints of a frame.
+    Args
+        name: The name of the counter.
+        value: Its value.
+        frame: The frame number the value belongs to, if known.
+    """
+    if not enabled:
+        return
+    event = {'name': name, 'ph': 'C', 'ts': _now(), 'pid': _pid, 'tid': _thread_ident(),
+             'args': {name: value}}
+    if frame is not None:
+        event['frame'] = frame
+    events.append(event)
+
+
+def enable(path=None):
+    """Switch instrumentation on, and optionally change the file the trace is saved to."""
+    global enabled, output_path
+    enabled = True
+    if path is not None:
+        output_path = path
+
+
+def clear():
+    """Forget the recorded events."""
+    del events[:]
+
+
+def save(path=None):
+    """Save the recorded events.
+    Args
+        path: The file to save to, output_path if None. Files ending in .csv
+            get a CSV timeline, anything else a Chrome trace.
+    """
+    if not enabled:
+        return
+    path = path or output_path
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    recorded = list(events)
+    threads = dict(thread_names)
+
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('type', 'name', 'thread', 'frame', 'start_ms', 'duration_ms', 'value'))
+            for event in sorted(recorded, key=lambda event: event['ts']):
+                thread = threads.get(event['tid'], event['tid'])
+                if event['ph'] == 'X':
+                    writer.writerow(('span', event['name'], thread, event['args'].get('frame', ''),
+                                     '%.3f' % (event['ts'] / 1000), '%.3f' % (event['dur'] / 1000), ''))
+                else:
+                    writer.writerow(('counter', event['name'], thread, event.get('frame', ''),
+                                     '%.3f' % (event['ts'] / 1000), '', event['args'][event['name']]))
+        return
+
+    # Name the threads, so the decode and encode stages show up as such
+    metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': _pid, 'tid': tid, 'args': {'name': name}}
+                for tid, name in threads.items()]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': metadata + recorded, 'displayTimeUnit': 'ms'}, f)
@@ -3,46 +3,30 @@
 
 # Standard library imports
 import os
-import shutil
+from itertools import chain
 
 # Third party imports
-import ffmpeg
 import cv2
 import numpy as np
 
-import glfw
-from PIL import Image
-from OpenGL.GL import *
-
 # Local imports
 from settings import *
-from extrinsic_calibration import calibrate
+from frame_source import probe_video, read_frames
+from pipeline import relative_poses, ThreadedStage, ThreadedWriter
 import rasterize
+import instrument
+from transforms import rotation_vector_to_matrix, matrix_to_quaternion
+
+def resized_frames(frames, buffer_size):
+    """Add a copy of every frame that is resized to fit the framebuffer."""
+    for frame_number, image in frames:
+        with instrument.span('resize', frame=frame_number):
+            resized = cv2.resize(image, buffer_size)
+        yield frame_number, image, resized
 
 def main():
-    # clear the images folder
-    try:
-        shutil.rmtree(IMAGES_FOLDER)
-    except:
-        pass
-    os.mkdir(IMAGES_FOLDER)
-
-    # load the video frames into the images folder
-    ( ffmpeg.input(VIDEO_FILE_PATH)
-        # .filter('fps', fps='1/60')
-        .output(f'{IMAGES_FOLDER}/image%d.png',
-                start_number=0)
-        .overwrite_output()
-        .run()
-    )
-    video_resolution = ffmpeg.probe(VIDEO_FILE_PATH)['streams'][0]['width'], ffmpeg.probe(VIDEO_FILE_PATH)['streams'][0]['height']
-    video_resolution = np.array(video_resolution)
-    video_frame_count = int(ffmpeg.probe(VIDEO_FILE_PATH)['streams'][0]['nb_frames'])
-
-    frame_number = SKIP_START
-    # Load the first frame of the video
-    image1 = cv2.imread(f'{IMAGES_FOLDER}/image{frame_number}.png', cv2.IMREAD_COLOR)
-    
+    video_resolution, video_frame_count = probe_video(VIDEO_FILE_PATH)
+
     total_Rotation = np.array(OBJECT_ROTATION)
     total_Translation = np.array(OBJECT_POSITION)[:, np.newaxis]
 
@@ -53,18 +37,29 @@ def main():
     camera.position = np.array([total_Translation[0], total_Translation[1], total_Translation[2]])[:, np.newaxis]  
     camera.rotation = total_Rotation
 
-    # Resize image to fit the framebuffer
-    image1_resized = cv2.resize(image1, rasterize.buffer_size)
+    # Stream only the frames we are going to use out of the video
+    frame_numbers = [SKIP_START, *range(SKIP_START + 1, video_frame_count, SKIP_FRAMES)]
+    frames = resized_frames(read_frames(VIDEO_FILE_PATH, frame_numbers, video_resolution), rasterize.buffer_size)
+    if PIPELINE_THREADS:
+        frames = ThreadedStage(frames, PIPELINE_QUEUE_SIZE, "decode")
+
+    # Load the first frame of the video
+    first_frame = next(frames)
+    frame_number, image1, image1_resized = first_frame
 
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    width, height = glfw.get_window_size(window)
+    width, height = rasterize.buffer_size
     if not os.path.exists(os.path.dirname(OUTPUT_FILE_PATH)):
         os.mkdir(os.path.dirname(OUTPUT_FILE_PATH))
     out = cv2.VideoWriter(OUTPUT_FILE_PATH,fourcc, 20.0, (width,height))
+    if PIPELINE_THREADS:
+        out = ThreadedWriter(out, PIPELINE_QUEUE_SIZE)
 
-    # Draw the first frame
+    # Draw the first frame. With asynchronous readback, draw() returns the
+    # previous frame, so there is nothing to write yet.
     snapshot = rasterize.draw(camera, obj, window, clock, image1_resized)
-    out.write(snapshot)
+    if snapshot is not None:
+        out.write(snapshot)
 
     timestamps = []
     with open(GROUNDTRUTH_FILE_PATH, "r") as truth_file:
@@ -72,33 +67,19 @@ def main():
         timestamps = [line.split()[0] for line in lines]
 
     pred = []
-    points3D = np.array([])
-    matches = np.array([])
-    for i in range(SKIP_START + 1, video_frame_count, SKIP_FRAMES):
-        frame_number = i
+    # The relative poses come back in order, even when computed in parallel
+    poses = relative_poses(chain([first_frame], frames),
+                           CAMERA_FOCAL_LENGTH, CAMERA_PRINCIPAL_POINT)
+    if PIPELINE_THREADS:
+        poses = ThreadedStage(poses, PIPELINE_QUEUE_SIZE, "pose")
+    for frame_number, image2, R, t, image2_resized in poses:
         rasterize.handle_events(window)
 
-        # Load the next frame of the video
-        image2 = cv2.imread(f'{IMAGES_FOLDER}/image{frame_number}.png', cv2.IMREAD_COLOR)
-        if image2 is None:
-            break
-
-        # Resize image to fit the framebuffer
-        image2_resized = cv2.resize(image2, rasterize.buffer_size)
-
-        # calibrate the images
-        R, t, points3D, matches = calibrate(
-            image1, image2, 
-            focal_length=CAMERA_FOCAL_LENGTH,
-            principal_point=CAMERA_PRINCIPAL_POINT,
-            last_frame_points3D=points3D,
-            last_frame_matches=matches
-        )
-
         # Combine the rotation and translation
-        R = cv2.Rodrigues(R)[0]
-        t = np.array([-t[0], t[1], t[2]])[:, np.newaxis]
-        cv2.composeRT(total_Rotation, total_Translation, R, t, total_Rotation, total_Translation)
+        with instrument.span('compose', frame=frame_number):
+            R = cv2.Rodrigues(R)[0]
+            t = np.array([-t[0], t[1], t[2]])[:, np.newaxis]
+            cv2.composeRT(total_Rotation, total_Translation, R, t, total_Rotation, total_Translation)
 
         # Update the position and rotation of the object
         # camera.position = total_Translation
@@ -110,27 +91,38 @@ def main():
         print(f"Translation: {total_Translation}")
 
         # Draw the object
-        snapshot = rasterize.draw(camera, obj, window, clock, image2_resized)
-        out.write(snapshot)
+        with instrument.span('draw', frame=frame_number):
+            snapshot = rasterize.draw(camera, obj, window, clock, image2_resized)
+        if snapshot is not None:
+            with instrument.span('write', frame=frame_number):
+                out.write(snapshot)
         # cv2.imwrite("test.jpg", snapshot)
 
         tx, ty, tz = (total_Translation[0][0], -total_Translation[2][0], -total_Translation[1][0])
         rx, ry, rz = (total_Rotation[0], total_Rotation[1], total_Rotation[2])
-        rot = rasterize.rotation_vector_to_matrix(np.array([rx, rz, ry]))
-        qx, qy, qz, qw = rasterize.matrix_to_quaternion(rot)
+        rot = rotation_vector_to_matrix(np.array([rx, rz, ry]))
+        qx, qy, qz, qw = matrix_to_quaternion(rot)
         timestamp = timestamps[frame_number] if frame_number < len(timestamps) else timestamps[-1]
         pred.append(f"{timestamp} {tx} {ty} {tz} {qx} {qy} {qz} {qw}\n")
 
-        # Load the next frame of the video
-        image1 = image2
         clock.tick(60)
 
+    # Write the frame that is still being read back
+    snapshot = rasterize.finish()
+    if snapshot is not None:
+        out.write(snapshot)
+
     with open(PREDICTED_FILE_PATH, "w+") as pred_file:
         pred_file.writelines(pred)
 
     out.release()
-    
-    shutil.rmtree(IMAGES_FOLDER)
+
+    if PIPELINE_THREADS:
+        # The queue in front of the slowest stage is the one that fills up
+        for stage in (frames, poses, out):
+            print(stage.report())
+
+    instrument.save()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+"""Pipeline module.
+This module estimates the relative camera motion between consecutive video
+frames, either in this process or spread over a pool of worker processes,
+and lets the stages of the video pipeline run in their own threads.
+"""
+
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import cv2
+
+from settings import POSE_WORKERS, POSE_CHUNK_SIZE
+from extrinsic_calibration import calibrate
+from features import create_tracker
+import instrument
+
+
+def _init_worker():
+    # The workers already run in parallel, so keep OpenCV single threaded
+    cv2.setNumThreads(1)
+
+
+def _calibrate_chunk(frames, focal_length, principal_point):
+    """Calibrate every pair of consecutive frames in a chunk.
+    Runs in a worker process with a fresh tracker, which reuses the features
+    of each frame for the next pair of the chunk. A worker may be handed any
+    chunk, so nothing is carried over from the chunk it ran before.
+    """
+    tracker = create_tracker()
+    poses = []
+    for (index1, image1), (index2, image2) in zip(frames, frames[1:]):
+        R, t, _, _ = calibrate(image1, image2, focal_length=focal_length,
+                               principal_point=principal_point, tracker=tracker,
+                               frame_indices=(index1, index2))
+        poses.append((R, t))
+    return poses
+
+
+def relative_poses(frames, focal_length, principal_point, workers=POSE_WORKERS, chunk_size=POSE_CHUNK_SIZE):
+    """Estimate the motion between every pair of consecutive frames.
+    Args
+        frames: Iterable of (frame_number, image, *extra) tuples. Any extra
+            items are passed through unchanged.
+        focal_length: The focal length of the camera.
+        principal_point: The principal point of the camera.
+        workers: The number of worker processes, or 0 to run in this process.
+        chunk_size: The number of frame pairs handed to a worker at a time.
+
+    Yields
+    ------
+        Tuples of (frame_number, image, R, t, *extra) for every frame but the
+        first, in video order, where R and t are the output of calibrate()
+        between the previous frame and this one.
+    """
+    frames = iter(frames)
+    previous = next(frames, None)
+    if previous is None:
+        return
+
+    if workers == 0:
+        # Keeps the features of image2 around to be reused as image1 next step
+        tracker = create_tracker()
+        for frame_number, image, *extra in frames:
+            R, t, _, _ = calibrate(previous[1], image, focal_length=focal_length,
+                                   principal_point=principal_point, tracker=tracker,
+                                   frame_indices=(previous[0], frame_number))
+            yield frame_number, image, R, t, *extra
+            previous = (frame_number, image)
+        return
+
+    # Chunks overlap by one frame, and only a few are in flight at a time so
+    # that memory does not grow with the length of the video
+    pending = deque()
+    # Forking a process whose other threads may hold OpenCV or ffmpeg locks
+    # can deadlock the workers, so start them fresh
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker) as executor:
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = [previous, *islice(frames, chunk_size)]
+                if len(chunk) < 2:
+                    break
+                # Only the frame numbers and images are sent to the workers
+                future = executor.submit(_calibrate_chunk, [frame[:2] for frame in chunk],
+                                         focal_length, principal_point)
+                pending.append((chunk, future))
+                previous = chunk[-1]
+            if not pending:
+                break
+            chunk, future = pending.popleft()
+            for (frame_number, image, *extra), (R, t) in zip(chunk[1:], future.result()):
+                yield frame_number, image, R, t, *extra
+
+
+class _Failure:
+    """Carries an exception from a stage thread to the consuming thread."""
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+class _QueuedStage:
+    """A pipeline stage that runs in a background thread behind a bounded queue.
+    The queue depth is sampled on every item that passes through it: the
+    queue in front of the slowest stage is usually full, and the queues
+    after it are usually empty.
+    """
+
+    def __init__(self, maxsize, name):
+        self.name = name
+        self.queue = queue.Queue(maxsize)
+        self.max_depth = 0
+        self._depth_sum = 0
+        self._samples = 0
+
+    def _start(self, target, *args):
+        self._thread = threading.Thread(target=target, args=args, name=self.name, daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        depth = self.queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        self._depth_sum += depth
+        self._samples += 1
+
+    def report(self):
+        """Describe the queue depth of the stage."""
+        mean_depth = self._depth_sum / max(self._samples, 1)
+        return f"{self.name} queue: mean depth {mean_depth:.1f}, max depth {self.max_depth} of {self.queue.maxsize}"
+
+
+class ThreadedStage(_QueuedStage):
+    """Produces the items of an iterable in a background thread.
+    The thread stays at most maxsize items ahead of the consumer.
+    Args
+        iterable: The items to produce in the background.
+        maxsize: The maximum number of buffered items.
+        name: The name of the stage in reports.
+    """
+
+    def __init__(self, iterable, maxsize, name):
+        super().__init__(maxsize, name)
+        self._start(self._run, iterable)
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                self.queue.put(item)
+        except BaseException as error:
+            self.queue.put(_Failure(error))
+        else:
+            self.queue.put(_DONE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._sample()
+        item = self.queue.get()
+        if item is _DONE:
+            # Leave the marker for any later calls
+            self.queue.put(_DONE)
+            raise StopIteration
+        if isinstance(item, _Failure):
+            raise item.error
+        return item
+
+
+class ThreadedWriter(_QueuedStage):
+    """Writes frames to a cv2.VideoWriter from a background thread.
+    Args
+        writer: The cv2.VideoWriter to write to.
+        maxsize: The maximum number of frames waiting to be written.
+        name: The name of the stage in reports.
+    """
+
+    def __init__(self, writer, maxsize, name="encode"):
+        super().__init__(maxsize, name)
+        self.writer = writer
+        self._error = None
+        self._start(self._run)
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is _DONE:
+                break
+            # After a failure keep draining the queue so write() never blocks
+            if self._error is None:
+                try:
+                    with instrument.span('encode'):
+                        self.writer.write(frame)
+                except BaseException as error:
+                    self._error = error
+
+    def write(self, frame):
+        """Queue a frame to be written."""
+        self._sample()
+        self.queue.put(frame)
+
+    def release(self):
+        """Wait for the queued frames to be written and release the writer."""
+        self.queue.put(_DONE)
+        self._thread.join()
+        self.writer.release()
+        if self._error is not None:
+            raise self._error
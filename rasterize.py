@@ -3,19 +3,22 @@ This module contains functions that create images of a given 3d object
 from a given camera perspective.
 """
 
+import os
+import ctypes
 import numpy as np
-import pygame
-from pygame.locals import *
+from settings import *
+if RENDER_OFFSCREEN and OFFSCREEN_BACKEND == "egl":
+    # PyOpenGL has to load its EGL bindings before OpenGL.GL is imported
+    os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from tools.objloader import *
+from transforms import rotation_vector_to_matrix, rotation_vector_to_quaternion, matrix_to_quaternion
+import instrument
 import sys
 from dataclasses import dataclass, asdict
 import glfw
-import cv2
-from PIL import Image
 
-from settings import *
 from itertools import product
 
 
@@ -25,41 +28,36 @@ class Camera:
     position: np.ndarray = None
 
 buffer_size = None
+# The framebuffer objects that are rendered to and read from when offscreen
+render_fbo = None
+resolve_fbo = None
+# Keeps the EGL display, surface and context alive when rendering with EGL
+egl_context = None
+# The pixel buffer objects for asynchronous readback, the (width, height)
+# they were made for, the next one to read into and the one holding the
+# pixels of the previous frame
+pack_buffers = None
+pack_size = None
+pack_index = 0
+pack_pending = None
+# The texture holding the background video frame, the pixel buffer it is
+# uploaded through and the (width, height) it was allocated with
+background_texture = None
+background_buffer = None
+background_size = None
 
-def rotation_vector_to_matrix(rotation_vector):
-    rotation_vector = np.array([-rotation_vector[0], -rotation_vector[1], -rotation_vector[2]])
-    rot = cv2.Rodrigues(rotation_vector)[0]
-    # Make the rotation matrix homogeneous
-    rot = np.concatenate((rot, np.zeros((1, 3))), axis=0)
-    rot = np.concatenate((rot, np.zeros((4, 1))), axis=1)
-    rot[3, 3] = 1
-    return rot
-
-def rotation_vector_to_quaternion(rotation_vector):
-    rotation_vector = np.array([-rotation_vector[0], -rotation_vector[1], -rotation_vector[2]])
-    rot = cv2.Rodrigues(rotation_vector)[0]
-    return matrix_to_quaternion(rot)
-
-def matrix_to_quaternion(m):
-    if m[2,2] < 0:
-        if m[0,0] > m[1,1]:
-            t = 1 + m[0,0] - m[1,1] - m[2,2]
-            q = (t, m[0,1] + m[1,0], m[2,0] + m[0,2], m[1,2] - m[2,1])
-        else:
-            t = 1 - m[0,0] + m[1,1] - m[2,2]
-            q = (m[0,1] + m[1,0], t, m[1,2] + m[2,1], m[2,0] - m[0,2])
-    else:
-        if m[0,0] < -m[1,1]:
-            t = 1 - m[0,0] - m[1,1] + m[2,2]
-            q = (m[2,0] + m[0,2], m[1,2] + m[2,1], t, m[0,1] - m[1,0])
-        else:
-            t = 1 + m[0,0] + m[1,1] + m[2,2]
-            q = (m[1,2] - m[2,1], m[2,0] - m[0,2], m[0,1] - m[1,0], t)
+class UnlimitedClock:
+    """Stands in for pygame.time.Clock when frames should not be throttled."""
+    def tick(self, framerate=0):
+        return 0
 
-    q = np.array(q)
-    q *= 0.5 / np.sqrt(t)
-
-    return q
+def grid_matrices():
+    """Get the model matrices of the copies of the object in the OBJECT_GRID."""
+    grid_positions = [-2, -1, 0, 1, 2]
+    offsets = np.array(list(product(grid_positions, repeat=3))) * OBJECT_POSITION
+    matrices = np.tile(np.identity(4), (len(offsets), 1, 1))
+    matrices[:, :3, 3] = offsets
+    return matrices
 
 def window_update(window, width, height):
     global buffer_size
@@ -72,23 +70,94 @@ def window_update(window, width, height):
     buffer_size = glfw.get_framebuffer_size(window)
     glViewport(0, 0, width, height)
 
+def create_egl_context():
+    """Create an OpenGL context on a surfaceless EGL display.
+    This needs no window system at all, so it works on headless machines.
+    """
+    from OpenGL import EGL
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    if not EGL.eglInitialize(display, None, None):
+        raise RuntimeError("EGL display initialization failed")
+    config_attributes = (EGL.EGLint * 5)(EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                                         EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_NONE)
+    config = EGL.EGLConfig()
+    num_configs = EGL.EGLint()
+    EGL.eglChooseConfig(display, config_attributes, ctypes.pointer(config), 1, ctypes.pointer(num_configs))
+    if num_configs.value == 0:
+        raise RuntimeError("No EGL config supports desktop OpenGL")
+    # All drawing goes to a framebuffer object, so the surface can be tiny
+    surface = EGL.eglCreatePbufferSurface(display, config, (EGL.EGLint * 5)(EGL.EGL_WIDTH, 1, EGL.EGL_HEIGHT, 1, EGL.EGL_NONE))
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+    if not EGL.eglMakeCurrent(display, surface, surface, context):
+        raise RuntimeError("EGL context creation failed")
+    return display, surface, context
+
+def create_framebuffers(width, height, samples=4):
+    """Create a multisampled framebuffer to render to and a plain one to read from."""
+    global render_fbo, resolve_fbo
+    framebuffers = []
+    for fbo_samples in (samples, 0):
+        fbo = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+        color, depth = glGenRenderbuffers(2)
+        glBindRenderbuffer(GL_RENDERBUFFER, color)
+        glRenderbufferStorageMultisample(GL_RENDERBUFFER, fbo_samples, GL_RGBA8, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, color)
+        glBindRenderbuffer(GL_RENDERBUFFER, depth)
+        glRenderbufferStorageMultisample(GL_RENDERBUFFER, fbo_samples, GL_DEPTH_COMPONENT24, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth)
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("Offscreen framebuffer is incomplete")
+        framebuffers.append(fbo)
+    render_fbo, resolve_fbo = framebuffers
+    glBindFramebuffer(GL_FRAMEBUFFER, render_fbo)
+
 def init(focal_distance, principal_point, video_size=(800, 600)):
-    global buffer_size
-    glfw.init()
+    global buffer_size, egl_context
     viewport = video_size
-    glfw.window_hint(glfw.SAMPLES, 4)
-    clock = pygame.time.Clock()
-    window = glfw.create_window(*viewport, "OpenGL window", None, None)
-    glfw.set_window_close_callback(
-        window, lambda x: glfw.set_window_should_close(window, True))
-    glfw.set_window_size_callback(window, window_update)
-    buffer_size = glfw.get_framebuffer_size(window)
-    if not window:
-        glfw.terminate()
-        print("GLFW window creation failed")
-        sys.exit()
-    glfw.make_context_current(window)
+    if RENDER_OFFSCREEN:
+        # Render into a framebuffer object as fast as possible, without
+        # swapping buffers or waiting for vsync
+        clock = UnlimitedClock()
+        if OFFSCREEN_BACKEND == "egl":
+            egl_context = create_egl_context()
+            window = None
+        else:
+            glfw.init()
+            glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
+            window = glfw.create_window(*viewport, "OpenGL window", None, None)
+            if not window:
+                glfw.terminate()
+                print("GLFW window creation failed")
+                sys.exit()
+            glfw.make_context_current(window)
+            glfw.swap_interval(0)
+        buffer_size = tuple(int(x) for x in viewport)
+        create_framebuffers(*buffer_size)
+        glViewport(0, 0, *buffer_size)
+    else:
+        glfw.init()
+        glfw.window_hint(glfw.SAMPLES, 4)
+        # pygame is only needed to throttle the onscreen frame rate
+        import pygame
+        clock = pygame.time.Clock()
+        window = glfw.create_window(*viewport, "OpenGL window", None, None)
+        glfw.set_window_close_callback(
+            window, lambda x: glfw.set_window_should_close(window, True))
+        glfw.set_window_size_callback(window, window_update)
+        buffer_size = glfw.get_framebuffer_size(window)
+        if not window:
+            glfw.terminate()
+            print("GLFW window creation failed")
+            sys.exit()
+        glfw.make_context_current(window)
+    # Rows of BGR pixels are not padded to a multiple of 4 bytes
+    glPixelStorei(GL_PACK_ALIGNMENT, 1)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
     obj = OBJ('objects/rubberduckie/rubberduckie.obj')
+    if OBJECT_GRID:
+        obj.set_instances(grid_matrices())
 
     glLightfv(GL_LIGHT0, GL_POSITION,  (-40, 200, 100, 0.0))
     glLightfv(GL_LIGHT0, GL_AMBIENT, (0.2, 0.2, 0.2, 1.0))
@@ -119,23 +188,78 @@ def init(focal_distance, principal_point, video_size=(800, 600)):
     return window, obj, clock, Camera()
 
 def handle_events(window):
+    if window is None:
+        return
     glfw.poll_events()
 
     if glfw.window_should_close(window):
         glfw.terminate()
         sys.exit()
 
+def upload_background(frame):
+    """Stream a BGR frame into the background texture through a pixel buffer."""
+    global background_texture, background_buffer, background_size
+    height, width = frame.shape[:2]
+    if background_texture is None:
+        background_texture = glGenTextures(1)
+        background_buffer = glGenBuffers(1)
+    glBindTexture(GL_TEXTURE_2D, background_texture)
+    if background_size != (width, height):
+        # Allocate the texture once, later frames only replace its contents
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB8, width, height, 0, GL_BGR, GL_UNSIGNED_BYTE, None)
+        background_size = (width, height)
+
+    size = width * height * 3
+    glBindBuffer(GL_PIXEL_UNPACK_BUFFER, background_buffer)
+    # Orphan the old storage so we never wait for the previous upload
+    glBufferData(GL_PIXEL_UNPACK_BUFFER, size, None, GL_STREAM_DRAW)
+    address = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, size, GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT)
+    pixels = np.frombuffer((ctypes.c_ubyte * size).from_address(address), np.uint8)
+    np.copyto(pixels.reshape(frame.shape), frame)
+    glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+    glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, width, height, GL_BGR, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+    glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+
+def draw_background(frame):
+    """Draw a BGR frame as a full-screen textured quad."""
+    # Restores the texture binding and state that the object is drawn with
+    glPushAttrib(GL_ENABLE_BIT | GL_TEXTURE_BIT | GL_CURRENT_BIT)
+    upload_background(frame)
+    glDisable(GL_LIGHTING)
+    glDisable(GL_DEPTH_TEST)
+    glEnable(GL_TEXTURE_2D)
+    glTexEnvi(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_REPLACE)
+    glMatrixMode(GL_PROJECTION)
+    glPushMatrix()
+    glLoadIdentity()
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+    # The first row of the frame is the top of the image, so the texture
+    # coordinates flip it instead of the CPU
+    glBegin(GL_QUADS)
+    glTexCoord2f(0, 1); glVertex2f(-1, -1)
+    glTexCoord2f(1, 1); glVertex2f(1, -1)
+    glTexCoord2f(1, 0); glVertex2f(1, 1)
+    glTexCoord2f(0, 0); glVertex2f(-1, 1)
+    glEnd()
+    glMatrixMode(GL_PROJECTION)
+    glPopMatrix()
+    glMatrixMode(GL_MODELVIEW)
+    glPopAttrib()
+
 def draw(camera: Camera, obj, window, clock, frame=None, quaternion=None):
+    if RENDER_OFFSCREEN:
+        glBindFramebuffer(GL_FRAMEBUFFER, render_fbo)
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
     # If frame is not None, draw the frame as the background
     if frame is not None:
-        glLoadIdentity()
-        glWindowPos2i(0, 0)
-        frame = np.flip(frame, axis=0)
-        # frame = np.concatenate((frame, np.zeros((frame.shape[0], 1), dtype=np.uint8)), axis=1)
-        b_size = buffer_size
-        glDrawPixels(*buffer_size, GL_BGR, GL_UNSIGNED_BYTE, frame)
+        with instrument.span('background'):
+            draw_background(frame)
         # clear the depth buffer so that the frame is not occluded
         glClear(GL_DEPTH_BUFFER_BIT)
 
@@ -143,25 +267,99 @@ def draw(camera: Camera, obj, window, clock, frame=None, quaternion=None):
     rot = rotation_vector_to_matrix(camera.rotation)
     rot = np.linalg.inv(rot)
 
-    grid_positions = [-2, -1, 0, 1, 2]
-    if not OBJECT_GRID:
-        grid_positions = [1]
-    for i, j, k in product(grid_positions, repeat=3):
-        # RENDER OBJECT
+    # RENDER OBJECT
+    with instrument.span('render'):
         glLoadIdentity()
         pos = -camera.position.T
         glMultMatrixd(rot) # Rotate object
-        glTranslate(OBJECT_POSITION[0] * i, OBJECT_POSITION[1] * j, OBJECT_POSITION[2] * k) # Move object away from camera
-        # glTranslate(*OBJECT_POSITION ) # Move object away from camera
-        glTranslate(*pos.T) # TODO: fix this
-        glCallList(obj.gl_list)
+        if OBJECT_GRID:
+            # Every copy in the grid is moved away from the camera by its own
+            # instance transform
+            glTranslate(*pos.T)
+            obj.render_instanced()
+        else:
+            glTranslate(*OBJECT_POSITION) # Move object away from camera
+            glTranslate(*pos.T) # TODO: fix this
+            obj.render()
+
+        if RENDER_OFFSCREEN:
+            # Resolve the multisampled image into the framebuffer we read from
+            glBindFramebuffer(GL_READ_FRAMEBUFFER, render_fbo)
+            glBindFramebuffer(GL_DRAW_FRAMEBUFFER, resolve_fbo)
+            glBlitFramebuffer(0, 0, *buffer_size, 0, 0, *buffer_size, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+            glBindFramebuffer(GL_READ_FRAMEBUFFER, resolve_fbo)
+        else:
+            glfw.swap_buffers(window) # draw the current frame
 
-    glfw.swap_buffers(window) # draw the current frame
+    width, height = buffer_size
+    instrument.counter('readback_bytes', width * height * 3)
+    with instrument.span('readback'):
+        if ASYNC_READBACK:
+            return read_pixels_async()
 
-    screenshot = glReadPixels(0,0,*buffer_size,GL_BGR,GL_UNSIGNED_BYTE)
-    # glReadBuffer(GL_BACK)
-    snapshot = Image.frombuffer("RGB",buffer_size,screenshot,"raw", "RGB", 0, 0)
-    snapshot = np.array(snapshot)
-    snapshot = cv2.flip(snapshot,0)
+        screenshot = glReadPixels(0,0,*buffer_size,GL_BGR,GL_UNSIGNED_BYTE)
+        # glReadBuffer(GL_BACK)
+        # OpenGL rows start at the bottom, so flip while making the only copy
+        snapshot = np.frombuffer(screenshot, np.uint8).reshape(height, width, 3)[::-1].copy()
+
+    return snapshot
+
+def create_pack_buffers(width, height):
+    """Create the two pixel buffer objects that frames are read back into."""
+    global pack_buffers, pack_size, pack_pending
+    if pack_buffers is not None:
+        glDeleteBuffers(2, pack_buffers)
+    pack_buffers = glGenBuffers(2)
+    pack_size = (width, height)
+    pack_pending = None
+    for buffer in pack_buffers:
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, buffer)
+        glBufferData(GL_PIXEL_PACK_BUFFER, width * height * 3, None, GL_STREAM_READ)
+    glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+def map_pack_buffer(buffer):
+    """Copy the pixels out of a pixel buffer object, flipped right side up."""
+    width, height = pack_size
+    glBindBuffer(GL_PIXEL_PACK_BUFFER, buffer)
+    address = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, width * height * 3, GL_MAP_READ_BIT)
+    pixels = (ctypes.c_ubyte * (width * height * 3)).from_address(address)
+    # A view of the mapped memory, which is only valid until it is unmapped
+    view = np.frombuffer(pixels, np.uint8).reshape(height, width, 3)
+    snapshot = view[::-1].copy()
+    glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+    return snapshot
+
+def read_pixels_async():
+    """Start reading back this frame and return the previous one.
+    The pixels of the current frame are transferred into one pixel buffer
+    object while the previous frame is copied out of the other, so the CPU
+    does not wait for the GPU to finish rendering.
+
+    Returns
+    -------
+        The previous frame, or None if there is none. Call finish() to get
+        the last frame.
+    """
+    global pack_index, pack_pending
+    if pack_buffers is None or pack_size != tuple(buffer_size):
+        create_pack_buffers(*buffer_size)
+
+    glBindBuffer(GL_PIXEL_PACK_BUFFER, pack_buffers[pack_index])
+    glReadPixels(0, 0, *pack_size, GL_BGR, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+    snapshot = None
+    if pack_pending is not None:
+        snapshot = map_pack_buffer(pack_pending)
+    pack_pending = pack_buffers[pack_index]
+    pack_index = 1 - pack_index
+    glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+    return snapshot
 
+def finish():
+    """Return the frame whose pixels are still being read back, if any."""
+    global pack_pending
+    if pack_pending is None:
+        return None
+    snapshot = map_pack_buffer(pack_pending)
+    pack_pending = None
+    glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
     return snapshot
@@ -7,14 +7,85 @@ OUTPUT_FILE_PATH = "output/desk_1.mp4"
 GROUNDTRUTH_FILE_PATH = "videos/desk_1_groundtruth_interpolated.txt"
 PREDICTED_FILE_PATH = "videos/desk_1_predicted.txt"
 
-IMAGES_FOLDER = "images"
-
 CAMERA_FOCAL_LENGTH = 525
 CAMERA_PRINCIPAL_POINT = (319.5, 239.5)
 
 # CAMERA_FOCAL_LENGTH = 200
 # CAMERA_PRINCIPAL_POINT = (928//2, 566//2)
 
+# The feature detector used for visual odometry: "SIFT", "ORB", "AKAZE" or "BRISK".
+# SIFT is the most accurate, the binary ORB/AKAZE/BRISK features are faster.
+FEATURE_DETECTOR = "SIFT"
+
+# The descriptor matcher: "BF" for brute force, or "FLANN" for approximate
+# matching (a KD-tree for SIFT, locality sensitive hashing for binary features).
+FEATURE_MATCHER = "BF"
+
+# Only keep matches that are also the best match from the second frame to the
+# first one. This removes more outliers but doubles the matching cost.
+MATCH_MUTUAL_CHECK = False
+
+# How correspondences between frames are found: "match" detects and matches
+# features on every frame, "klt" only detects corners on keyframes and follows
+# them with optical flow in between, which is much faster for small motions.
+TRACKING_MODE = "match"
+
+# Features are found and tracked on a copy of the frames that is halved until
+# it is at most this many pixels wide, so that the cost per frame stays about
+# the same for higher resolution videos. The focal length and principal point
+# are scaled to match. Set to 0 to always use the full resolution.
+FEATURE_MAX_WIDTH = 640
+
+# Move the points found on a smaller copy to sub-pixel corner positions in the
+# full resolution frames before the camera motion is estimated.
+FEATURE_REFINE = False
+
+# Keep at most this many keypoints per frame in "match" mode, so that matching
+# takes about as long on every frame. The frame is split into a grid of
+# FEATURE_GRID (columns, rows) cells, and only the FEATURE_CELL_KEYPOINTS
+# strongest keypoints of every cell are kept, which spreads them over the
+# frame. Set to 0 to keep every keypoint.
+FEATURE_MAX_KEYPOINTS = 2000
+FEATURE_GRID = (8, 6)
+FEATURE_CELL_KEYPOINTS = 80
+
+# On frames with fewer than this many keypoints, such as dark or blurry ones,
+# the threshold of the detector is lowered a few times to find more. Frames
+# with at least this many are only detected once. Set to 0 to never retry.
+FEATURE_MIN_KEYPOINTS = 500
+
+# The number of corners detected on a keyframe in "klt" mode.
+KLT_MAX_CORNERS = 1000
+
+# A new keyframe is started when fewer tracks than this survive...
+KLT_MIN_TRACKS = 150
+
+# ...or when the tracks have moved this many pixels (median) since the keyframe.
+KLT_MAX_PARALLAX = 40.0
+
+# The number of worker processes that estimate the camera motion between
+# frames in parallel. Set to 0 to estimate it in the main process.
+POSE_WORKERS = 0
+
+# The number of consecutive frame pairs handed to a worker at a time.
+POSE_CHUNK_SIZE = 8
+
+# Run decoding, pose estimation and video encoding in their own threads, so
+# that they overlap with rendering instead of waiting for each other.
+PIPELINE_THREADS = True
+
+# The number of frames each threaded stage may get ahead of the next one.
+PIPELINE_QUEUE_SIZE = 8
+
+# Record how long the stages of every frame take, along with counters such as
+# the number of keypoints and RANSAC inliers, and save them to INSTRUMENT_OUTPUT
+# when the video is done. Files ending in .csv get a CSV timeline, anything
+# else a Chrome trace (open it in chrome://tracing or ui.perfetto.dev).
+# Setting the PIPELINE_TRACE environment variable to a file name also turns it
+# on. Stages that run in POSE_WORKERS processes are not recorded.
+INSTRUMENT = False
+INSTRUMENT_OUTPUT = "output/trace.json"
+
 # The number of frames to skip between each frame.
 SKIP_FRAMES = 2
 
@@ -31,4 +102,18 @@ OBJECT_POSITION = (0., 0, -30.) # For video xyz
 OBJECT_ROTATION = [0., 0., 0.]
 
 # Show a grid of multiple objects?
-OBJECT_GRID = False
\ No newline at end of file
+OBJECT_GRID = False
+
+# Render into an offscreen framebuffer instead of a window on the screen.
+# Offscreen rendering skips buffer swaps and frame rate limits, and runs as
+# fast as the GPU allows.
+RENDER_OFFSCREEN = False
+
+# How the offscreen OpenGL context is created: "glfw" uses a hidden window,
+# "egl" needs no display at all, e.g. on headless render machines.
+OFFSCREEN_BACKEND = "glfw"
+
+# Read the rendered frames back through two alternating pixel buffers, so
+# that copying out one frame overlaps with rendering the next. The output
+# video is unchanged, but every frame is returned one draw call later.
+ASYNC_READBACK = True
@@ -0,0 +1,274 @@
+"""Synthetic scene module.
+This module renders a camera moving through a box shaped room along a known
+trajectory, so that the visual odometry and its evaluation can be run on
+any resolution and length with exact ground truth, without any recorded
+video. Every wall has its own tileable noise texture, and the frames are
+rendered by casting a ray per pixel in NumPy and sampling the textures with
+cv2.remap.
+
+The camera follows the OpenCV and TUM conventions: x points right, y down
+and z forward, and the poses of the ground truth map camera coordinates to
+world coordinates.
+
+Usage:
+    python synthetic.py name [--resolution 1920x1080] [--frames 300] [--density 1.0]
+    python synthetic.py name --frames 100000 --trajectory_only --noise 0.001
+"""
+
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+from settings import CAMERA_FOCAL_LENGTH
+from trajectory import TRAJECTORY_DTYPE, quaternions_to_matrices, save_trajectory
+
+# The half extents of the room in meters, centered on the origin
+ROOM_SIZE = (4.0, 1.5, 4.0)
+
+# The BGR colors that the textures of the six walls are tinted with
+WALL_TINTS = np.array([
+    (255, 230, 210), (210, 230, 255), (230, 255, 230),
+    (255, 255, 220), (240, 220, 255), (220, 250, 255),
+], np.uint8)
+# A lookup table from wall index to its tint, for cv2.LUT
+_TINT_TABLE = np.zeros((1, 256, 3), np.uint8)
+_TINT_TABLE[0, :len(WALL_TINTS)] = WALL_TINTS
+
+# The wavelengths in meters of the detail in the textures, at a density of 1
+TEXTURE_WAVELENGTHS = (0.5, 0.12, 0.03)
+
+
+def noise_texture(size, wavelengths, rng):
+    """Make a tileable grayscale noise texture.
+    White noise is smoothed with a Gaussian of every wavelength in the
+    frequency domain, which makes the texture wrap around seamlessly.
+    Args
+        size: The width and height of the texture in texels.
+        wavelengths: The sizes of the detail in texels.
+        rng: The numpy random Generator to draw the noise from.
+
+    Returns
+    -------
+        A size x size uint8 image.
+    """
+    frequencies = np.hypot(np.fft.fftfreq(size)[:, np.newaxis], np.fft.rfftfreq(size)[np.newaxis, :])
+    spectrum = np.zeros(frequencies.shape)
+    for wavelength in wavelengths:
+        sigma = max(wavelength, 1.0) / 4
+        # Scaled so that every wavelength has about the same contrast
+        spectrum += sigma * np.exp(-2 * (np.pi * sigma * frequencies) ** 2)
+    texture = np.fft.irfft2(np.fft.rfft2(rng.standard_normal((size, size))) * spectrum, s=(size, size))
+    texture = (texture - texture.mean()) / texture.std()
+    return np.clip(128 + 45 * texture, 0, 255).astype(np.uint8)
+
+
+class Scene:
+    """A textured box shaped room that renders frames from any camera pose.
+    Args
+        resolution: The (width, height) of the frames.
+        focal_length: The focal length in pixels. Scaled from
+            CAMERA_FOCAL_LENGTH at 640 pixels wide if None.
+        principal_point: The principal point, the center of the frame if None.
+        room: The half extents of the room in meters.
+        density: Scales how fine the detail in the textures is, and with it
+            the number of features in the frames.
+        seed: The seed of the textures.
+    """
+
+    def __init__(self, resolution, focal_length=None, principal_point=None, room=ROOM_SIZE, density=1.0, seed=0):
+        width, height = resolution
+        self.resolution = (int(width), int(height))
+        self.focal_length = CAMERA_FOCAL_LENGTH * width / 640 if focal_length is None else focal_length
+        self.principal_point = ((width - 1) / 2, (height - 1) / 2) if principal_point is None else principal_point
+        self.room = np.array(room, np.float32)
+
+        # The directions of the rays through the pixels, in camera coordinates
+        # with z = 1, kept as a row and a column that are broadcast together
+        self._x = ((np.arange(width, dtype=np.float32) - self.principal_point[0]) / self.focal_length)[np.newaxis, :]
+        self._y = ((np.arange(height, dtype=np.float32) - self.principal_point[1]) / self.focal_length)[:, np.newaxis]
+
+        # About one texel per pixel on a wall two meters away. A texture
+        # covers a few meters before it repeats.
+        self.texels_per_meter = self.focal_length / 2
+        self.texture_size = int(np.clip(2 ** np.ceil(np.log2(4 * self.texels_per_meter)), 512, 4096))
+        wavelengths = [wavelength / density * self.texels_per_meter for wavelength in TEXTURE_WAVELENGTHS]
+        rng = np.random.default_rng(seed)
+        # The walls are stacked in one atlas, each padded with a border that
+        # wraps around so that bilinear sampling never bleeds into the next
+        self.atlas = np.concatenate([np.pad(noise_texture(self.texture_size, wavelengths, rng), 1, mode='wrap')
+                                     for _ in range(6)])
+
+    def render(self, position, rotation):
+        """Render the frame seen from a camera pose.
+        Args
+            position: The position of the camera, inside the room.
+            rotation: The 3x3 rotation from camera to world coordinates.
+
+        Returns
+        -------
+            An HxWx3 BGR image.
+        """
+        cx, cy, cz = np.asarray(position, np.float32)
+        R = np.asarray(rotation, np.float32)
+        dx = R[0, 0] * self._x + R[0, 1] * self._y + R[0, 2]
+        dy = R[1, 0] * self._x + R[1, 1] * self._y + R[1, 2]
+        dz = R[2, 0] * self._x + R[2, 1] * self._y + R[2, 2]
+
+        # The distance along each ray to the walls it heads towards
+        hx, hy, hz = self.room
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tx = (np.copysign(hx, dx) - cx) / dx
+            ty = (np.copysign(hy, dy) - cy) / dy
+            tz = (np.copysign(hz, dz) - cz) / dz
+        x_wall = (tx <= ty) & (tx <= tz)
+        y_wall = ~x_wall & (ty <= tz)
+        t = np.minimum(np.minimum(tx, ty), tz)
+
+        # The coordinates on the wall that was hit, in texels
+        u = np.where(x_wall, cz + t * dz, cx + t * dx) * self.texels_per_meter
+        v = np.where(y_wall, cz + t * dz, cy + t * dy) * self.texels_per_meter
+        wall = np.where(x_wall, 0 + (dx > 0),
+                        np.where(y_wall, 2 + (dy > 0), 4 + (dz > 0))).astype(np.uint8)
+
+        size = self.texture_size
+        map_x = np.mod(u, size) + 1
+        map_y = np.mod(v, size) + 1 + wall * np.float32(size + 2)
+        gray = cv2.remap(self.atlas, map_x, map_y, cv2.INTER_LINEAR)
+        tint = cv2.LUT(cv2.cvtColor(wall, cv2.COLOR_GRAY2BGR), _TINT_TABLE)
+        return cv2.multiply(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), tint, scale=1 / 255)
+
+
+def _axis_quaternions(axis, angles):
+    """Get the (x, y, z, w) quaternions of rotations by angles around a coordinate axis."""
+    q = np.zeros((len(angles), 4))
+    q[:, axis] = np.sin(angles / 2)
+    q[:, 3] = np.cos(angles / 2)
+    return q
+
+
+def _multiply_quaternions(q1, q2):
+    """Compose (x, y, z, w) quaternions, so that q2 is applied first."""
+    x1, y1, z1, w1 = q1.T
+    x2, y2, z2, w2 = q2.T
+    return np.stack((
+        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+        w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+        w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+        w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+    ), axis=1)
+
+
+def camera_trajectory(count, fps=30.0, room=ROOM_SIZE, speed=1.0, start=0.0):
+    """Make a smooth trajectory of a camera looking around inside the room.
+    The camera sways along every axis and turns its head, with periods that
+    do not line up, so long trajectories do not repeat for a long time.
+    Args
+        count: The number of poses.
+        fps: The number of poses per second.
+        room: The half extents of the room in meters.
+        speed: Scales how fast the camera moves.
+        start: The timestamp of the first pose.
+
+    Returns
+    -------
+        A structured array of TRAJECTORY_DTYPE.
+    """
+    stamps = start + np.arange(count) / fps
+    phase = 2 * np.pi * speed * (stamps - start)
+    trajectory = np.empty(count, TRAJECTORY_DTYPE)
+    trajectory['stamp'] = stamps
+    trajectory['position'] = 0.3 * np.array(room) * np.sin(phase[:, np.newaxis] / (13.0, 9.0, 19.0) + (0.0, 1.0, 2.0))
+    yaw = _axis_quaternions(1, 0.6 * np.sin(phase / 17.0))
+    pitch = _axis_quaternions(0, 0.15 * np.sin(phase / 11.0 + 0.5))
+    roll = _axis_quaternions(2, 0.05 * np.sin(phase / 7.0 + 1.5))
+    trajectory['orientation'] = _multiply_quaternions(yaw, _multiply_quaternions(pitch, roll))
+    return trajectory
+
+
+def perturb_trajectory(trajectory, noise, seed=0):
+    """Make an estimate of a trajectory that drifts away from it.
+    Both the position and the orientation follow a random walk.
+    Args
+        trajectory: A structured array of TRAJECTORY_DTYPE.
+        noise: The standard deviation of the steps of the walk, in meters
+            and radians.
+        seed: The seed of the walk.
+
+    Returns
+    -------
+        A structured array of TRAJECTORY_DTYPE.
+    """
+    rng = np.random.default_rng(seed)
+    perturbed = trajectory.copy()
+    perturbed['position'] += np.cumsum(rng.normal(0, noise, (len(trajectory), 3)), axis=0)
+    drift = np.cumsum(rng.normal(0, noise, (len(trajectory), 3)), axis=0)
+    angles = np.linalg.norm(drift, axis=1)
+    q = np.empty((len(trajectory), 4))
+    q[:, :3] = drift * (np.sinc(angles / (2 * np.pi)) / 2)[:, np.newaxis]
+    q[:, 3] = np.cos(angles / 2)
+    perturbed['orientation'] = _multiply_quaternions(trajectory['orientation'], q)
+    return perturbed
+
+
+def render_frames(scene, trajectory):
+    """Render the frames of a trajectory one at a time.
+    Yields
+    ------
+        Tuples of (frame_number, frame), like frame_source.read_frames().
+    """
+    for frame_number, pose in enumerate(trajectory):
+        rotation = quaternions_to_matrices(pose['orientation'])[0]
+        yield frame_number, scene.render(pose['position'], rotation)
+
+
+def write_sequence(name, directory="videos", resolution=(640, 480), count=300, fps=30.0, density=1.0, seed=0,
+                   noise=0.0, trajectory_only=False):
+    """Render a synthetic sequence and save it like the bundled videos.
+    Saves {name}.mp4 and {name}_groundtruth_interpolated.txt, which has a
+    pose for every frame, and {name}_predicted.txt with a drifting estimate
+    if noise is not 0.
+
+    Returns
+    -------
+        The paths of the saved files.
+    """
+    os.makedirs(directory, exist_ok=True)
+    trajectory = camera_trajectory(count, fps)
+    paths = [os.path.join(directory, f'{name}_groundtruth_interpolated.txt')]
+    save_trajectory(paths[0], trajectory)
+    if noise:
+        paths.append(os.path.join(directory, f'{name}_predicted.txt'))
+        save_trajectory(paths[-1], perturb_trajectory(trajectory, noise, seed))
+    if trajectory_only:
+        return paths
+
+    scene = Scene(resolution, density=density, seed=seed)
+    paths.append(os.path.join(directory, f'{name}.mp4'))
+    writer = cv2.VideoWriter(paths[-1], cv2.VideoWriter_fourcc(*'mp4v'), fps, scene.resolution)
+    try:
+        for _, frame in render_frames(scene, trajectory):
+            writer.write(frame)
+    finally:
+        writer.release()
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a synthetic video with exact ground truth.')
+    parser.add_argument('name', help='name of the sequence, e.g. synthetic_1080p')
+    parser.add_argument('--directory', default='videos', help='directory to save the sequence in (default: videos)')
+    parser.add_argument('--resolution', default='640x480', help='resolution of the frames (default: 640x480)')
+    parser.add_argument('--frames', type=int, default=300, help='number of frames (default: 300)')
+    parser.add_argument('--fps', type=float, default=30.0, help='frames per second (default: 30)')
+    parser.add_argument('--density', type=float, default=1.0, help='how fine the texture detail is (default: 1.0)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the textures and the noise (default: 0)')
+    parser.add_argument('--noise', type=float, default=0.0, help='also save a drifting estimate with this step size')
+    parser.add_argument('--trajectory_only', action='store_true', help='only save the trajectories, not the video')
+    args = parser.parse_args()
+
+    resolution = tuple(int(x) for x in args.resolution.split('x'))
+    for path in write_sequence(args.name, args.directory, resolution, args.frames, args.fps, args.density,
+                               args.seed, args.noise, args.trajectory_only):
+        print(path)
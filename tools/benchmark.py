@@ -0,0 +1,339 @@
+"""Benchmarks the visual odometry, rendering and encoding of the pipeline.
+Runs the stages of main.main() one after the other on the bundled videos,
+or on synthetic frames when the videos cannot be decoded, and times every
+stage of every frame separately: decode, detect, refine, match, essential,
+recover_pose and the rest of calibrate() (pose_other), compose, draw and
+write. The pose stages are timed through the instrument spans of the
+calibrate() that main.main() runs. Reports the frame rate, the p50, p95
+and p99 latency of each stage and the peak memory use, and can save them as
+JSON and compare them with an earlier run.
+
+Usage:
+    python tools/benchmark.py [videos...] [--frames N] [--output results.json]
+    python tools/benchmark.py --baseline results.json --threshold 0.1
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cv2
+import numpy as np
+
+import settings
+
+STAGES = ('decode', 'detect', 'refine', 'match', 'essential', 'recover_pose', 'pose_other', 'compose', 'draw', 'write')
+
+# The stage of each span that calibrate() records through the instrument
+# module. Tracking with optical flow counts as matching.
+CALIBRATE_SPANS = {
+    'detect': 'detect',
+    'refine': 'refine',
+    'match': 'match',
+    'track': 'match',
+    'essential': 'essential',
+    'recover_pose': 'recover_pose',
+}
+
+# Stages faster than this are left out of the regression check, their
+# timings are mostly noise
+MIN_REGRESSION_MS = 0.1
+
+
+class StageTimer:
+    """Collects the durations of the stages of every frame."""
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+        self.frames = []
+        self._frame = 0.0
+
+    def add(self, stage, seconds):
+        self.samples[stage].append(seconds)
+        self._frame += seconds
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def end_frame(self):
+        """Record the total latency of the frame whose stages were just measured."""
+        self.frames.append(self._frame)
+        self._frame = 0.0
+
+
+def percentiles(seconds):
+    """Summarize a list of durations in milliseconds."""
+    milliseconds = np.asarray(seconds) * 1000
+    p50, p95, p99 = np.percentile(milliseconds, (50, 95, 99))
+    return {'mean_ms': float(np.mean(milliseconds)), 'p50_ms': float(p50),
+            'p95_ms': float(p95), 'p99_ms': float(p99), 'total_s': float(np.sum(milliseconds) / 1000)}
+
+
+def peak_rss_mb():
+    """Get the peak resident memory of this process and of its finished children, in MB."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if platform.system() == 'Darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2**20,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2**20)
+
+
+def synthetic_frames(resolution=(640, 480), count=100, seed=0):
+    """Render frames of a camera moving through the synthetic room.
+    Args
+        resolution: The (width, height) of the frames.
+        count: The number of frames.
+        seed: The seed of the textures.
+
+    Returns
+    -------
+        An iterator of (frame_number, frame), like frame_source.read_frames().
+        The textures are made up front, so that only the rendering is timed.
+    """
+    import synthetic
+    scene = synthetic.Scene(resolution, seed=seed)
+    return synthetic.render_frames(scene, synthetic.camera_trajectory(count))
+
+
+def video_frames(path, count, skip):
+    """Decode the frames of a video that main.main() would use.
+    Returns
+    -------
+        The (width, height) of the video, and an iterator of (frame_number, frame).
+    """
+    from frame_source import probe_video, read_frames
+    resolution, frame_count = probe_video(path)
+    frame_numbers = range(settings.SKIP_START, frame_count, skip)[:count]
+    return tuple(int(x) for x in resolution), read_frames(path, frame_numbers, resolution)
+
+
+def init_renderer(resolution, backend):
+    """Set up offscreen rendering.
+    Returns
+    -------
+        The rasterize module and the window, object, clock and camera of
+        rasterize.init(), or None if no OpenGL context could be created.
+    """
+    settings.RENDER_OFFSCREEN = True
+    settings.OFFSCREEN_BACKEND = backend
+    try:
+        import rasterize
+        window, obj, clock, camera = rasterize.init(settings.CAMERA_FOCAL_LENGTH, settings.CAMERA_PRINCIPAL_POINT,
+                                                    np.array(resolution))
+    except Exception as error:
+        print(f"Rendering is not benchmarked, no OpenGL context: {error!r}", file=sys.stderr)
+        return None
+    camera.position = np.array(settings.OBJECT_POSITION)[:, np.newaxis]
+    camera.rotation = np.array(settings.OBJECT_ROTATION)
+    return rasterize, window, obj, clock, camera
+
+
+def run(name, frames, resolution, renderer, tracking_mode):
+    """Run the pipeline on a sequence of frames and time its stages.
+    Args
+        name: The name of the run in the results.
+        frames: Iterable of (frame_number, frame).
+        resolution: The (width, height) of the frames.
+        renderer: The result of init_renderer(), or None to skip drawing.
+        tracking_mode: "match" or "klt", see settings.TRACKING_MODE.
+
+    Returns
+    -------
+        A dict with the results of the run.
+    """
+    import instrument
+    from extrinsic_calibration import calibrate
+    from features import create_tracker
+
+    # calibrate() is timed through its own spans, so the benchmark follows
+    # whatever it does
+    instrument.enable()
+
+    focal_length = settings.CAMERA_FOCAL_LENGTH
+    principal_point = settings.CAMERA_PRINCIPAL_POINT
+    tracker = create_tracker(tracking_mode)
+    timer = StageTimer()
+    total_rotation = np.array(settings.OBJECT_ROTATION, np.float64)
+    total_translation = np.array(settings.OBJECT_POSITION, np.float64)[:, np.newaxis]
+    size = renderer[0].buffer_size if renderer else resolution
+
+    output = os.path.join(tempfile.mkdtemp(), 'benchmark.mp4')
+    writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*'mp4v'), 20.0, tuple(size))
+    frames = iter(frames)
+    previous = None
+    start = time.perf_counter()
+    while True:
+        decode_start = time.perf_counter()
+        item = next(frames, None)
+        if item is None:
+            break
+        frame_number, image = item
+        resized = cv2.resize(image, tuple(size))
+        timer.add('decode', time.perf_counter() - decode_start)
+
+        if previous is not None:
+            seen = len(instrument.events)
+            calibrate_start = time.perf_counter()
+            R, t, _, _ = calibrate(previous[1], image, focal_length, principal_point, tracker=tracker,
+                                   frame_indices=(previous[0], frame_number))
+            # Whatever the spans of calibrate() do not cover counts as pose_other
+            remainder = time.perf_counter() - calibrate_start
+            thread = threading.get_ident()
+            for event in instrument.events[seen:]:
+                if event['ph'] == 'X' and event['tid'] == thread and event['name'] in CALIBRATE_SPANS:
+                    timer.add(CALIBRATE_SPANS[event['name']], event['dur'] / 1e6)
+                    remainder -= event['dur'] / 1e6
+            timer.add('pose_other', max(remainder, 0.0))
+            with timer.measure('compose'):
+                # The same composition as main.main()
+                R = cv2.Rodrigues(R)[0]
+                t = np.array([-t[0], t[1], t[2]])
+                cv2.composeRT(total_rotation, total_translation, R, t, total_rotation, total_translation)
+
+        snapshot = resized
+        if renderer:
+            rasterize, window, obj, clock, camera = renderer
+            with timer.measure('draw'):
+                camera.position = total_translation * 0.5
+                camera.rotation = np.array([total_rotation[0], total_rotation[1], -total_rotation[2]])
+                snapshot = rasterize.draw(camera, obj, window, clock, resized)
+        if snapshot is not None:
+            with timer.measure('write'):
+                writer.write(snapshot)
+        timer.end_frame()
+        previous = (frame_number, image)
+
+    if renderer:
+        snapshot = renderer[0].finish()
+        if snapshot is not None:
+            writer.write(snapshot)
+    writer.release()
+    wall = time.perf_counter() - start
+    os.remove(output)
+
+    if not timer.frames:
+        raise ValueError(f"{name} has no frames")
+    rss, rss_children = peak_rss_mb()
+    return {
+        'name': name,
+        'resolution': list(resolution),
+        'frames': len(timer.frames),
+        'wall_s': wall,
+        'fps': len(timer.frames) / wall,
+        'latency': percentiles(timer.frames),
+        'stages': {stage: percentiles(samples) for stage, samples in timer.samples.items() if samples},
+        'peak_rss_mb': rss,
+        'peak_rss_children_mb': rss_children,
+    }
+
+
+def print_run(result):
+    print(f"{result['name']}: {result['frames']} frames at {result['resolution'][0]}x{result['resolution'][1]}, "
+          f"{result['fps']:.1f} fps, peak RSS {result['peak_rss_mb']:.0f} MB")
+    print(f"  {'stage':<13}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}  ms")
+    for stage, stats in [*result['stages'].items(), ('frame', result['latency'])]:
+        print(f"  {stage:<13}{stats['mean_ms']:9.2f}{stats['p50_ms']:9.2f}{stats['p95_ms']:9.2f}{stats['p99_ms']:9.2f}")
+
+
+def compare(results, baseline, threshold):
+    """Compare the results of a benchmark with an earlier run.
+    Args
+        results: The results of this run.
+        baseline: The results of the earlier run.
+        threshold: The allowed slowdown, e.g. 0.1 for 10%.
+
+    Returns
+    -------
+        A list describing every regression, empty if there are none.
+    """
+    regressions = []
+    earlier_runs = {run['name']: run for run in baseline['runs']}
+    for result in results['runs']:
+        earlier = earlier_runs.get(result['name'])
+        if earlier is None:
+            continue
+        if result['fps'] < earlier['fps'] * (1 - threshold):
+            regressions.append(f"{result['name']}: {result['fps']:.1f} fps, was {earlier['fps']:.1f} fps")
+        for stage, stats in result['stages'].items():
+            earlier_stats = earlier['stages'].get(stage)
+            if earlier_stats is None or earlier_stats['p50_ms'] < MIN_REGRESSION_MS:
+                continue
+            if stats['p50_ms'] > earlier_stats['p50_ms'] * (1 + threshold):
+                regressions.append(f"{result['name']} {stage}: p50 {stats['p50_ms']:.2f} ms, "
+                                   f"was {earlier_stats['p50_ms']:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the video pipeline.')
+    parser.add_argument('videos', nargs='*', help='videos to run on (default: videos/*.mp4)')
+    parser.add_argument('--frames', type=int, default=60, help='number of frames per video (default: 60)')
+    parser.add_argument('--skip', type=int, default=settings.SKIP_FRAMES, help='frames to skip between used frames')
+    parser.add_argument('--synthetic', action='store_true', help='run on synthetic frames instead of the videos')
+    parser.add_argument('--resolution', default='640x480', help='resolution of the synthetic frames (default: 640x480)')
+    parser.add_argument('--tracking', default=settings.TRACKING_MODE, choices=('match', 'klt'), help='tracking mode')
+    parser.add_argument('--no_render', action='store_true', help='do not draw the object')
+    parser.add_argument('--backend', default='egl', choices=('egl', 'glfw'), help='offscreen OpenGL backend (default: egl)')
+    parser.add_argument('--output', help='save the results as JSON to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown compared with the baseline (default: 0.1)')
+    args = parser.parse_args()
+    os.chdir(ROOT)
+
+    sources = []
+    if not args.synthetic:
+        for path in args.videos or sorted(glob.glob('videos/*.mp4')):
+            try:
+                resolution, frames = video_frames(path, args.frames, args.skip)
+            except Exception as error:
+                print(f"Cannot decode {path}: {error!r}", file=sys.stderr)
+                continue
+            sources.append((os.path.basename(path), resolution, frames))
+    if not sources:
+        resolution = tuple(int(x) for x in args.resolution.split('x'))
+        sources.append((f"synthetic_{args.resolution}", resolution, synthetic_frames(resolution, args.frames)))
+
+    results = {
+        'config': {'tracking': args.tracking, 'detector': settings.FEATURE_DETECTOR,
+                   'matcher': settings.FEATURE_MATCHER, 'frames': args.frames, 'skip': args.skip,
+                   'render': not args.no_render, 'backend': args.backend},
+        'runs': [],
+    }
+    renderer = None
+    for name, resolution, frames in sources:
+        # The framebuffer is sized for the first video and reused for the rest
+        if renderer is None and not args.no_render:
+            renderer = init_renderer(resolution, args.backend) or False
+        result = run(name, frames, resolution, renderer or None, args.tracking)
+        results['runs'].append(result)
+        print_run(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Checks that calibrate() copes with frames that have no features.
+Blank frames, e.g. during a fade to black, yield no keypoints at all. Every
+tracker is run on pairs of a blank and a textured frame, and fails the check
+unless calibrate() returns the identity pose for them.
+
+Usage: python tools/check_calibrate.py
+"""
+
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from extrinsic_calibration import calibrate  # noqa: E402
+from features import FeatureTracker, OpticalFlowTracker  # noqa: E402
+
+SIZE = (480, 640)
+
+TRACKERS = {
+    'match': lambda: FeatureTracker(),
+    'match, every keypoint': lambda: FeatureTracker(max_keypoints=0),
+    'match, refined': lambda: FeatureTracker(max_width=320, refine=True),
+    'klt': lambda: OpticalFlowTracker(),
+}
+
+
+def textured_frame(seed=0):
+    """Create a frame of random blocks, which has plenty of features."""
+    blocks = np.random.default_rng(seed).integers(0, 256, (SIZE[0] // 16, SIZE[1] // 16, 3), np.uint8)
+    return np.repeat(np.repeat(blocks, 16, axis=0), 16, axis=1)
+
+
+def main():
+    blank = np.zeros((*SIZE, 3), np.uint8)
+    pairs = {
+        'blank to blank': (blank, blank),
+        'blank to textured': (blank, textured_frame()),
+        'textured to blank': (textured_frame(), blank),
+    }
+    failed = False
+    for tracker_name, create in TRACKERS.items():
+        for pair_name, (image1, image2) in pairs.items():
+            try:
+                R, t, _, _ = calibrate(image1, image2, focal_length=500.0, principal_point=(320.0, 240.0),
+                                       tracker=create(), frame_indices=(0, 1))
+            except Exception as error:
+                print(f'{tracker_name}, {pair_name}: {type(error).__name__}: {error}  FAIL')
+                failed = True
+                continue
+            ok = np.allclose(R, np.identity(3)) and np.allclose(t, 0)
+            print(f'{tracker_name}, {pair_name}: {"ok" if ok else "FAIL, not the identity pose"}')
+            failed |= not ok
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
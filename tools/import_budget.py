@@ -0,0 +1,80 @@
+"""Checks that the modules batch jobs import start quickly.
+Every module is imported in a fresh interpreter with `python -X importtime`,
+and fails the check if its import takes longer than its budget or pulls in
+one of the heavy rendering and vision packages.
+
+Usage: python tools/import_budget.py [--repeat N]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Seconds each module may take to import, including numpy
+BUDGETS = {
+    'settings': 0.05,
+    'instrument': 0.05,
+    'transforms': 0.25,
+    'trajectory': 0.25,
+    'evaluate_rpe': 0.25,
+    'evaluate_ate': 0.25,
+}
+# Packages that only the renderer and the pose estimation should import
+HEAVY_PACKAGES = ('cv2', 'matplotlib', 'OpenGL', 'pygame', 'glfw', 'PIL')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter.
+    Returns
+    -------
+        A dict of the cumulative import time in seconds of every module
+        that was imported along with it.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def check(module, budget, repeat=3):
+    """Check the import of a module against its budget.
+    Returns
+    -------
+        A list of the problems found, empty if there are none.
+    """
+    # Take the fastest of a few runs, the first one may hit a cold disk cache
+    runs = [import_times(module) for _ in range(repeat)]
+    seconds = min(run[module] for run in runs)
+    problems = []
+    if seconds > budget:
+        problems.append(f"{module} took {seconds * 1000:.0f} ms to import, over its budget of {budget * 1000:.0f} ms")
+    heavy = sorted({name for name in runs[0] if name.split('.')[0] in HEAVY_PACKAGES})
+    if heavy:
+        problems.append(f"{module} imports {', '.join(heavy)}")
+    print(f"{module}: {seconds * 1000:.0f} ms (budget {budget * 1000:.0f} ms)")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help='imports per module, the fastest one counts')
+    args = parser.parse_args()
+
+    problems = []
+    for module, budget in BUDGETS.items():
+        problems += check(module, budget, args.repeat)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,47 @@
 """Credit to https://www.pygame.org/wiki/OBJFileLoader for the code below."""
-import pygame
+import ctypes
+import hashlib
+import json
+import os
+import numpy as np
 from OpenGL.GL import *
+from OpenGL.GL import shaders
 import pathlib
 
+# Draws instanced copies of a mesh with the fixed-function lighting of
+# rasterize: one directional light, and material colours from glColor.
+INSTANCED_VERTEX_SHADER = """
+#version 120
+attribute mat4 instance_matrix;
+varying vec2 texcoord;
+void main() {
+    vec4 position = instance_matrix * gl_Vertex;
+    vec3 normal = normalize(gl_NormalMatrix * mat3(instance_matrix) * gl_Normal);
+    vec3 light = normalize(gl_LightSource[0].position.xyz);
+    vec4 ambient = (gl_LightModel.ambient + gl_LightSource[0].ambient) * gl_Color;
+    vec4 diffuse = max(dot(normal, light), 0.0) * gl_LightSource[0].diffuse * gl_Color;
+    gl_FrontColor = clamp(vec4((ambient + diffuse).rgb, gl_Color.a), 0.0, 1.0);
+    texcoord = gl_MultiTexCoord0.xy;
+    gl_Position = gl_ModelViewProjectionMatrix * position;
+}
+"""
+
+INSTANCED_FRAGMENT_SHADER = """
+#version 120
+uniform bool use_texture;
+uniform sampler2D diffuse_texture;
+varying vec2 texcoord;
+void main() {
+    gl_FragColor = gl_Color;
+    if (use_texture) {
+        gl_FragColor *= texture2D(diffuse_texture, texcoord);
+    }
+}
+"""
+
+instanced_program = None
+
+
 def MTL(filename):
     contents = {}
     mtl = None
@@ -19,6 +58,7 @@ def MTL(filename):
         elif values[0] == 'map_Kd':
             # load the texture referred to by this declaration
             mtl[values[0]] = values[1]
+            import pygame
             surf = pygame.image.load(mtl['map_Kd'])
             image = pygame.image.tostring(surf, 'RGBA', 1)
             ix, iy = surf.get_rect().size
@@ -35,14 +75,142 @@ def MTL(filename):
     return contents
 
 
+# Bump this when the layout of the cached mesh data changes
+MESH_CACHE_VERSION = 1
+
+
+def mesh_cache_paths(filename):
+    """Get the paths of the vertex data and metadata cached for an OBJ file."""
+    return filename + '.meshcache.npy', filename + '.meshcache.json'
+
+
+def file_digest(filename):
+    """Get the SHA-1 of a file's contents."""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_floats(lines, start, width):
+    """Convert OBJ records that hold numbers into an (N, width) array.
+    Args
+        lines: The lines of the records.
+        start: The length of the record prefix, e.g. 3 for 'vn '.
+        width: The number of leading numbers to keep from every record.
+    """
+    values = np.fromstring(' '.join([line[start:] for line in lines]), sep=' ')
+    if len(values) == width * len(lines):
+        return values.reshape(-1, width)
+    # Records with extra columns, e.g. vertex colours
+    columns = len(lines[0].split()) - 1
+    if columns > width and len(values) == columns * len(lines):
+        return values.reshape(-1, columns)[:, :width]
+    return np.array([line.split()[1:width + 1] for line in lines], np.float64).reshape(-1, width)
+
+
+def triangle_vertex_data(vertices, normals, texcoords, indices):
+    """Gather the interleaved vertex data of a list of triangles.
+    Args
+        vertices: (V, 3) array of positions.
+        normals: (N + 1, 3) array of normals, where row 0 is unused.
+        texcoords: (T + 1, 2) array of texture coordinates, where row 0 is (0, 0).
+        indices: (3 * K, 3) array of 1-based position, normal and texture
+            coordinate indices of the corners of K triangles. A normal or
+            texture coordinate index of 0 means it is missing.
+
+    Returns
+    -------
+        (3 * K, 8) array of position, normal and texture coordinate per corner.
+    """
+    positions = vertices[indices[:, 0] - 1]
+    vertex_normals = normals[indices[:, 1]]
+    missing = indices[:, 1] == 0
+    if missing.any():
+        # Fall back to the normal of the triangle
+        triangles = positions.reshape(-1, 3, 3)
+        face_normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        face_normals /= np.maximum(np.linalg.norm(face_normals, axis=1, keepdims=True), 1e-12)
+        vertex_normals[missing] = np.repeat(face_normals, 3, axis=0)[missing]
+    return np.hstack((positions, vertex_normals, texcoords[indices[:, 2]]))
+
+
 class OBJ:
-    def __init__(self, filename, swapyz=False):
-        """Load a Wavefront OBJ file. """
+    def __init__(self, filename, swapyz=False, cache=True):
+        """Load a Wavefront OBJ file.
+        The triangulated vertex data is cached in a binary file next to the
+        OBJ file, so later loads skip parsing until the OBJ file changes.
+        Meshes loaded from the cache leave vertices, normals, texcoords and
+        faces empty.
+        """
         self.vertices = []
         self.normals = []
         self.texcoords = []
         self.faces = []
+        self.mtllib = None
+
+        if not (cache and self.load_cache(filename, swapyz)):
+            if not self.parse_arrays(filename, swapyz):
+                self.parse(filename, swapyz)
+                self.build_arrays()
+            if cache:
+                self.save_cache(filename, swapyz)
+        if self.mtllib is not None:
+            self.mtl = MTL(str(pathlib.Path(filename).parent.joinpath(self.mtllib).resolve()))
+        self.upload()
+
+    def load_cache(self, filename, swapyz):
+        """Load the cached vertex data of an OBJ file if it is up to date.
+        Returns
+        -------
+            Whether the cache could be used.
+        """
+        data_path, meta_path = mesh_cache_paths(filename)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            stat = os.stat(filename)
+            if meta['version'] != MESH_CACHE_VERSION or meta['swapyz'] != swapyz:
+                return False
+            if (meta['size'], meta['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+                # The file may only have been touched, e.g. by a checkout
+                if meta['size'] != stat.st_size or meta['sha1'] != file_digest(filename):
+                    return False
+                meta['mtime_ns'] = stat.st_mtime_ns
+                self._write_meta(meta_path, meta)
+            vertex_data = np.load(data_path, mmap_mode='r')
+        except (OSError, ValueError, KeyError):
+            return False
+        self.vertex_data = vertex_data
+        self.groups = [tuple(group) for group in meta['groups']]
+        self.mtllib = meta['mtllib']
+        return True
+
+    def save_cache(self, filename, swapyz):
+        """Cache the vertex data of an OBJ file. Failing to write it is not an error."""
+        data_path, meta_path = mesh_cache_paths(filename)
+        stat = os.stat(filename)
+        meta = dict(version=MESH_CACHE_VERSION, swapyz=swapyz, size=stat.st_size,
+                    mtime_ns=stat.st_mtime_ns, sha1=file_digest(filename),
+                    groups=self.groups, mtllib=self.mtllib)
+        try:
+            with open(data_path + '.tmp', 'wb') as f:
+                np.save(f, self.vertex_data)
+            os.replace(data_path + '.tmp', data_path)
+            self._write_meta(meta_path, meta)
+        except OSError:
+            pass
 
+    @staticmethod
+    def _write_meta(meta_path, meta):
+        # Write the metadata last and atomically, it is what marks the cache valid
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def parse(self, filename, swapyz=False):
+        """Read the vertices, normals, texture coordinates and faces of an OBJ file."""
         material = None
         for line in open(filename, "r"):
             if line.startswith('#'):
@@ -65,7 +233,7 @@ class OBJ:
             elif values[0] in ('usemtl', 'usemat'):
                 material = values[1]
             elif values[0] == 'mtllib':
-                self.mtl = MTL(str(pathlib.Path(filename).parent.joinpath(values[1]).resolve()))
+                self.mtllib = values[1]
             elif values[0] == 'f':
                 face = []
                 texcoords = []
@@ -83,28 +251,227 @@ class OBJ:
                         norms.append(0)
                 self.faces.append((face, norms, texcoords, material))
 
-        self.gl_list = glGenLists(1)
-        glNewList(self.gl_list, GL_COMPILE)
-        glEnable(GL_TEXTURE_2D)
-        glFrontFace(GL_CCW)
-        for face in self.faces:
-            vertices, normals, texture_coords, material = face
+    def build_arrays(self):
+        """Triangulate the faces into interleaved vertex data, grouped by material.
+        Sets vertex_data to an (N, 8) float32 array of position, normal and
+        texture coordinate per vertex, and groups to a list of
+        (material, first, count) vertex ranges.
+        """
+        vertices = np.array(self.vertices, np.float32).reshape(-1, 3)
+        normals = np.array(self.normals, np.float32).reshape(-1, 3)
+        texcoords = np.array(self.texcoords, np.float32).reshape(-1, 2)
+        # Index 0 stands for a missing normal or texture coordinate
+        normals = np.concatenate((np.zeros((1, 3), np.float32), normals))
+        texcoords = np.concatenate((np.zeros((1, 2), np.float32), texcoords))
+
+        corners = {}
+        for face_vertices, face_normals, face_texcoords, material in self.faces:
+            # Split each convex polygon into a fan of triangles
+            for i in range(1, len(face_vertices) - 1):
+                corners.setdefault(material, []).extend(
+                    (face_vertices[j], face_normals[j], face_texcoords[j]) for j in (0, i, i + 1))
+
+        data = []
+        self.groups = []
+        first = 0
+        for material, indices in corners.items():
+            indices = np.array(indices, np.intp)
+            data.append(triangle_vertex_data(vertices, normals, texcoords, indices))
+            self.groups.append((material, first, len(indices)))
+            first += len(indices)
+        self.vertex_data = np.ascontiguousarray(np.concatenate(data) if data else np.zeros((0, 8)), np.float32)
+
+    def parse_arrays(self, filename, swapyz=False):
+        """Read an OBJ file straight into vertex data with bulk array operations.
+        Gives the same vertex_data and groups as parse() followed by
+        build_arrays(), without building Python lists per vertex or corner.
+        Leaves vertices, normals, texcoords and faces empty.
+        Returns
+        -------
+            Whether the file could be parsed. Files that mix face formats,
+            e.g. v/vt and v/vt/vn corners, are left to parse().
+        """
+        with open(filename, 'r') as f:
+            text = f.read().replace('\t', ' ')
+        lines = text.splitlines()
+        if '\n ' in text or text[:1] == ' ':
+            lines = [line.lstrip() for line in lines]
+
+        vertices = parse_floats([line for line in lines if line[:2] == 'v '], 2, 3)
+        normals = parse_floats([line for line in lines if line[:3] == 'vn '], 3, 3)
+        texcoords = parse_floats([line for line in lines if line[:3] == 'vt '], 3, 2)
+        if swapyz:
+            vertices = vertices[:, [0, 2, 1]]
+            normals = normals[:, [0, 2, 1]]
+        vertices = vertices.astype(np.float32)
+        # Index 0 stands for a missing normal or texture coordinate
+        normals = np.concatenate((np.zeros((1, 3), np.float32), normals.astype(np.float32)))
+        texcoords = np.concatenate((np.zeros((1, 2), np.float32), texcoords.astype(np.float32)))
+        mtllibs = [line.split()[1] for line in lines if line[:7] == 'mtllib ']
+        self.mtllib = mtllibs[-1] if mtllibs else None
 
+        # Every usemtl statement sets the material of the faces after it
+        face_lines = [i for i, line in enumerate(lines) if line[:2] == 'f ']
+        material_lines = [i for i, line in enumerate(lines) if line[:7] in ('usemtl ', 'usemat ')]
+        material_names = [None, *(lines[i].split()[1] for i in material_lines)]
+        face_materials = np.searchsorted(material_lines, face_lines)
+        names = {}
+        face_materials = np.array([names.setdefault(material_names[m], len(names)) for m in range(len(material_names))],
+                                  np.intp)[face_materials]
+
+        corners = '\n'.join([lines[i][2:] for i in face_lines])
+        if '  ' in corners or ' \n' in corners or corners[-1:] == ' ':
+            corners = '\n'.join([' '.join(face.split()) for face in corners.split('\n')])
+        # Count the corners of every face from the spaces that separate them
+        characters = np.frombuffer(corners.encode(), np.uint8)
+        face_of_character = np.cumsum(characters == ord('\n'))
+        corner_counts = np.bincount(face_of_character[characters == ord(' ')], minlength=len(face_lines)) + 1
+        corners = corners.replace('\n', ' ')
+
+        # All corners have to share one of the v, v/vt, v/vt/vn or v//vn formats
+        slashes = corners.split(' ', 1)[0].count('/')
+        if corners.count('/') != slashes * corner_counts.sum():
+            return False
+        indices = np.fromstring(corners.replace('//', '/0/').replace('/', ' '), np.intp, sep=' ')
+        if len(indices) != (slashes + 1) * corner_counts.sum():
+            return False
+        indices = indices.reshape(-1, slashes + 1)
+        # Reorder the columns to position, normal and texture coordinate
+        columns = np.array([0, 2 if slashes == 2 else -1, 1 if slashes >= 1 else -1])
+        indices = np.where(columns >= 0, indices[:, columns], 0)
+
+        # Split each convex polygon into a fan of triangles
+        triangle_counts = np.maximum(corner_counts - 2, 0)
+        triangle_faces = np.repeat(np.arange(len(face_lines)), triangle_counts)
+        first_corners = (np.cumsum(corner_counts) - corner_counts)[triangle_faces]
+        fan = np.arange(len(triangle_faces)) - np.repeat(np.cumsum(triangle_counts) - triangle_counts, triangle_counts)
+        triangles = first_corners[:, np.newaxis] + np.stack((np.zeros_like(fan), fan + 1, fan + 2), axis=1)
+
+        # Group the triangles by material, in the order the materials are first drawn
+        triangle_materials = face_materials[triangle_faces]
+        materials, first_triangles, counts = np.unique(triangle_materials, return_index=True, return_counts=True)
+        drawn = np.argsort(first_triangles)
+        rank = np.zeros(len(names), np.intp)
+        rank[materials[drawn]] = np.arange(len(drawn))
+        order = np.argsort(rank[triangle_materials], kind='stable')
+        indices = indices[triangles[order].ravel()]
+        self.vertex_data = np.ascontiguousarray(triangle_vertex_data(vertices, normals, texcoords, indices), np.float32)
+
+        names = list(names)
+        self.groups = []
+        first = 0
+        for material, count in zip(materials[drawn], counts[drawn]):
+            self.groups.append((names[material], first, 3 * int(count)))
+            first += 3 * int(count)
+        return True
+
+    def upload(self):
+        """Copy the vertex data into a vertex buffer and record its layout in a vertex array."""
+        self.vbo = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, self.vertex_data.nbytes, self.vertex_data, GL_STATIC_DRAW)
+
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+        stride = self.vertex_data.strides[0]
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_NORMAL_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glVertexPointer(3, GL_FLOAT, stride, ctypes.c_void_p(0))
+        glNormalPointer(GL_FLOAT, stride, ctypes.c_void_p(12))
+        glTexCoordPointer(2, GL_FLOAT, stride, ctypes.c_void_p(24))
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def render(self):
+        """Draw the object with one draw call per material."""
+        glFrontFace(GL_CCW)
+        glBindVertexArray(self.vao)
+        for material, first, count in self.groups:
             mtl = self.mtl[material]
             if 'texture_Kd' in mtl:
                 # use diffuse texmap
+                glEnable(GL_TEXTURE_2D)
                 glBindTexture(GL_TEXTURE_2D, mtl['texture_Kd'])
             else:
                 # just use diffuse colour
+                glDisable(GL_TEXTURE_2D)
                 glColor(*mtl['Kd'])
-
-            glBegin(GL_POLYGON)
-            for i in range(len(vertices)):
-                if normals[i] > 0:
-                    glNormal3fv(self.normals[normals[i] - 1])
-                if texture_coords[i] > 0:
-                    glTexCoord2fv(self.texcoords[texture_coords[i] - 1])
-                glVertex3fv(self.vertices[vertices[i] - 1])
-            glEnd()
+            glDrawArrays(GL_TRIANGLES, first, count)
         glDisable(GL_TEXTURE_2D)
-        glEndList()
+        glBindVertexArray(0)
+
+    def set_instances(self, matrices):
+        """Upload the transforms of the copies drawn by render_instanced().
+        Args
+            matrices: (N, 4, 4) array of model matrices, one per copy.
+        """
+        global instanced_program
+        if instanced_program is None:
+            instanced_program = shaders.compileProgram(
+                shaders.compileShader(INSTANCED_VERTEX_SHADER, GL_VERTEX_SHADER),
+                shaders.compileShader(INSTANCED_FRAGMENT_SHADER, GL_FRAGMENT_SHADER))
+        # GLSL matrices are column-major
+        matrices = np.ascontiguousarray(np.transpose(matrices, (0, 2, 1)), np.float32)
+        self.instance_count = len(matrices)
+        if getattr(self, 'instance_vbo', None) is None:
+            self.instance_vbo = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_vbo)
+        glBufferData(GL_ARRAY_BUFFER, matrices.nbytes, matrices, GL_STATIC_DRAW)
+
+        glBindVertexArray(self.vao)
+        location = glGetAttribLocation(instanced_program, 'instance_matrix')
+        # A mat4 attribute takes up four consecutive vec4 locations
+        for column in range(4):
+            glEnableVertexAttribArray(location + column)
+            glVertexAttribPointer(location + column, 4, GL_FLOAT, GL_FALSE, 64, ctypes.c_void_p(16 * column))
+            glVertexAttribDivisor(location + column, 1)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def render_instanced(self):
+        """Draw every copy given to set_instances() with one draw call per material."""
+        glUseProgram(instanced_program)
+        use_texture = glGetUniformLocation(instanced_program, 'use_texture')
+        glUniform1i(glGetUniformLocation(instanced_program, 'diffuse_texture'), 0)
+        glFrontFace(GL_CCW)
+        glBindVertexArray(self.vao)
+        for material, first, count in self.groups:
+            mtl = self.mtl[material]
+            if 'texture_Kd' in mtl:
+                glUniform1i(use_texture, 1)
+                glBindTexture(GL_TEXTURE_2D, mtl['texture_Kd'])
+            else:
+                glUniform1i(use_texture, 0)
+                glColor(*mtl['Kd'])
+            glDrawArraysInstanced(GL_TRIANGLES, first, count, self.instance_count)
+        glBindVertexArray(0)
+        glUseProgram(0)
+
+
+def compare_parsers(filename, swapyz=False):
+    """Check that parse_arrays() gives the same mesh as parse() and build_arrays().
+    Needs no OpenGL context, as the meshes are never uploaded.
+    """
+    reference = OBJ.__new__(OBJ)
+    reference.vertices, reference.normals, reference.texcoords, reference.faces = [], [], [], []
+    reference.mtllib = None
+    reference.parse(filename, swapyz)
+    reference.build_arrays()
+    bulk = OBJ.__new__(OBJ)
+    assert bulk.parse_arrays(filename, swapyz), "parse_arrays() could not parse the file"
+    assert bulk.mtllib == reference.mtllib, (bulk.mtllib, reference.mtllib)
+    assert bulk.groups == reference.groups, (bulk.groups, reference.groups)
+    assert bulk.vertex_data.dtype == reference.vertex_data.dtype
+    assert np.array_equal(bulk.vertex_data, reference.vertex_data)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    for path in sys.argv[1:] or ['objects/rubberduckie/rubberduckie.obj']:
+        for swapyz in (False, True):
+            compare_parsers(path, swapyz)
+        start = time.perf_counter()
+        OBJ.__new__(OBJ).parse_arrays(path)
+        print(f"{path}: parsers agree, bulk parse took {time.perf_counter() - start:.3f} s")
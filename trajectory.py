@@ -0,0 +1,302 @@
+"""Trajectory module.
+This module reads camera trajectories in the TUM format, one
+"timestamp tx ty tz qx qy qz qw" pose per line, into structured numpy
+arrays, and converts their poses to homogeneous matrices.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+# A pose of a trajectory: its timestamp, its position and its orientation as
+# an (x, y, z, w) quaternion
+TRAJECTORY_DTYPE = np.dtype([
+    ('stamp', np.float64),
+    ('position', np.float64, 3),
+    ('orientation', np.float64, 4),
+])
+
+# Bump this when the layout of the cached trajectories changes
+TRAJECTORY_CACHE_VERSION = 1
+
+_EPS = np.finfo(float).eps * 4.0
+
+
+def parse_trajectory(text, filename="<string>", strict=False):
+    """Parse the text of a TUM trajectory file.
+    Commas and tabs separate values like spaces, and lines starting with #
+    are comments. Poses with NaNs or an all-zero quaternion are skipped.
+    Args
+        text: The contents of the file.
+        filename: The name of the file, used in warnings and errors.
+        strict: Raise a ValueError instead of skipping poses, for files with
+            a pose for every frame whose rows have to line up with the frames.
+
+    Returns
+    -------
+        A structured array of TRAJECTORY_DTYPE with a row per pose, in file order.
+    """
+    lines = [line for line in text.replace(",", " ").replace("\t", " ").splitlines()
+             if line.strip() and not line.startswith("#")]
+    values = np.fromstring(" ".join(lines), sep=" ")
+    if len(values) != 8 * len(lines):
+        raise ValueError(f"'{filename}' does not have 8 values on every line")
+    values = values.reshape(-1, 8)
+
+    unset = (values[:, 4:8] == 0).all(axis=1)
+    nans = np.isnan(values).any(axis=1) & ~unset
+    if strict and (unset | nans).any():
+        raise ValueError(f"pose {np.flatnonzero(unset | nans)[0]} of '{filename}' has NaNs or an all-zero quaternion")
+    for i in np.flatnonzero(nans):
+        sys.stderr.write("Warning: line %d of file '%s' has NaNs, skipping line\n" % (i, filename))
+    values = values[~nans & ~unset]
+
+    trajectory = np.empty(len(values), TRAJECTORY_DTYPE)
+    trajectory['stamp'] = values[:, 0]
+    trajectory['position'] = values[:, 1:4]
+    trajectory['orientation'] = values[:, 4:8]
+    return trajectory
+
+
+def trajectory_cache_path(filename):
+    """Get the path of the binary copy of a trajectory file."""
+    return filename + '.trajectory.npz'
+
+
+def load_trajectory(filename, cache=False, strict=False):
+    """Read a TUM trajectory file.
+    Args
+        filename: Path to the trajectory file.
+        cache: Whether to keep a binary copy of the parsed trajectory next to
+            the file, which later loads read instead until the file changes.
+            Ignored when strict, as the copy does not record skipped poses.
+        strict: Raise a ValueError instead of skipping poses, see parse_trajectory().
+
+    Returns
+    -------
+        A structured array of TRAJECTORY_DTYPE with a row per pose, in file order.
+    """
+    if not cache or strict:
+        with open(filename, 'r') as f:
+            return parse_trajectory(f.read(), filename, strict)
+
+    cache_path = trajectory_cache_path(filename)
+    stat = os.stat(filename)
+    key = np.array((TRAJECTORY_CACHE_VERSION, stat.st_size, stat.st_mtime_ns), np.int64)
+    try:
+        with np.load(cache_path) as cached:
+            if np.array_equal(cached['key'], key):
+                return cached['trajectory']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with open(filename, 'r') as f:
+        trajectory = parse_trajectory(f.read(), filename)
+    try:
+        # Write atomically, so a reader never sees half a cache file
+        with open(cache_path + '.tmp', 'wb') as f:
+            np.savez(f, key=key, trajectory=trajectory)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError:
+        pass
+    return trajectory
+
+
+def save_trajectory(filename, trajectory):
+    """Write a trajectory to a TUM trajectory file.
+    Args
+        filename: Path to the trajectory file.
+        trajectory: A structured array of TRAJECTORY_DTYPE.
+    """
+    np.savetxt(filename, np.column_stack((trajectory['stamp'], trajectory['position'], trajectory['orientation'])))
+
+
+def slerp(q0, q1, weights):
+    """Spherically interpolate between pairs of (x, y, z, w) quaternions.
+    Takes the shorter way around, and falls back to normalized linear
+    interpolation when the quaternions are nearly the same.
+    Args
+        q0: (N, 4) array of the quaternions at weight 0.
+        q1: (N, 4) array of the quaternions at weight 1.
+        weights: (N,) array of interpolation weights between 0 and 1.
+
+    Returns
+    -------
+        (N, 4) array of unit quaternions.
+    """
+    q0 = q0 / np.linalg.norm(q0, axis=1, keepdims=True)
+    q1 = q1 / np.linalg.norm(q1, axis=1, keepdims=True)
+    dot = np.einsum('ni,ni->n', q0, q1)
+    # q and -q are the same rotation
+    q1 = np.where(dot[:, np.newaxis] < 0, -q1, q1)
+    dot = np.minimum(np.abs(dot), 1.0)
+
+    theta = np.arccos(dot)
+    sin_theta = np.sin(theta)
+    close = sin_theta < 1e-6
+    sin_theta[close] = 1.0
+    w0 = np.where(close, 1.0 - weights, np.sin((1.0 - weights) * theta) / sin_theta)
+    w1 = np.where(close, weights, np.sin(weights * theta) / sin_theta)
+    q = w0[:, np.newaxis] * q0 + w1[:, np.newaxis] * q1
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def interpolate_trajectory(trajectory, stamps):
+    """Resample a trajectory at the given timestamps.
+    Positions are interpolated linearly and orientations with slerp().
+    Timestamps before the first or after the last pose get that pose.
+    Args
+        trajectory: A structured array of TRAJECTORY_DTYPE, sorted by stamp.
+        stamps: The timestamps to resample the trajectory at.
+
+    Returns
+    -------
+        A structured array of TRAJECTORY_DTYPE with a row per timestamp.
+    """
+    stamps = np.asarray(stamps, dtype=np.float64)
+    left, right, weights = StampIndex(trajectory['stamp']).bracket(stamps)
+    resampled = np.empty(len(stamps), TRAJECTORY_DTYPE)
+    resampled['stamp'] = stamps
+    resampled['position'] = (trajectory['position'][left] * (1.0 - weights)[:, np.newaxis]
+                             + trajectory['position'][right] * weights[:, np.newaxis])
+    resampled['orientation'] = slerp(trajectory['orientation'][left], trajectory['orientation'][right], weights)
+    return resampled
+
+
+def quaternions_to_matrices(quaternions):
+    """Convert (x, y, z, w) quaternions to rotation matrices.
+    The quaternions do not have to be normalized. Ones that are close to zero
+    give the identity.
+    Args
+        quaternions: (N, 4) array of quaternions.
+
+    Returns
+    -------
+        (N, 3, 3) array of rotation matrices.
+    """
+    q = np.array(quaternions, dtype=np.float64).reshape(-1, 4)
+    # Computed like numpy.dot, so the matrices match a pose-by-pose conversion
+    nq = np.matmul(q[:, np.newaxis, :], q[:, :, np.newaxis])[:, 0, 0]
+    valid = nq >= _EPS
+    q[valid] *= np.sqrt(2.0 / nq[valid])[:, np.newaxis]
+    q[~valid] = 0
+    q = q[:, :, np.newaxis] * q[:, np.newaxis, :]
+    return np.stack((
+        1.0 - q[:, 1, 1] - q[:, 2, 2], q[:, 0, 1] - q[:, 2, 3], q[:, 0, 2] + q[:, 1, 3],
+        q[:, 0, 1] + q[:, 2, 3], 1.0 - q[:, 0, 0] - q[:, 2, 2], q[:, 1, 2] - q[:, 0, 3],
+        q[:, 0, 2] - q[:, 1, 3], q[:, 1, 2] + q[:, 0, 3], 1.0 - q[:, 0, 0] - q[:, 1, 1],
+    ), axis=1).reshape(-1, 3, 3)
+
+
+def trajectory_matrices(trajectory):
+    """Convert the poses of a trajectory to homogeneous matrices.
+    Args
+        trajectory: A structured array of TRAJECTORY_DTYPE.
+
+    Returns
+    -------
+        (N, 4, 4) array of poses.
+    """
+    matrices = np.zeros((len(trajectory), 4, 4))
+    matrices[:, :3, :3] = quaternions_to_matrices(trajectory['orientation'])
+    matrices[:, :3, 3] = trajectory['position']
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+
+class StampIndex:
+    """Finds the closest timestamps in a sorted array of timestamps, many at a time.
+    A timestamp halfway between two stamps gets the one the binary search of
+    evaluate_rpe.find_closest_index() would find first, so that associations
+    match the TUM evaluation scripts.
+    Args
+        stamps: The timestamps to search, in increasing order.
+    """
+
+    def __init__(self, stamps):
+        self.stamps = np.asarray(stamps, dtype=np.float64)
+        if len(self.stamps) == 0:
+            raise ValueError("cannot index an empty array of timestamps")
+        if np.any(np.diff(self.stamps) < 0):
+            raise ValueError("timestamps have to be sorted")
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def nearest(self, stamps, offset=0.0):
+        """Find the closest indexed timestamp to each of the given ones.
+        Args
+            stamps: Array of timestamps to look up.
+            offset: Added to the given timestamps before they are looked up.
+
+        Returns
+        -------
+            Array with the index of the closest indexed timestamp to each one.
+        """
+        stamps = np.asarray(stamps, dtype=np.float64) + offset
+        right = np.clip(np.searchsorted(self.stamps, stamps), 1, max(len(self) - 1, 1))
+        left = right - 1
+        if len(self) == 1:
+            return np.zeros(stamps.shape, dtype=np.intp)
+        left_difference = np.abs(self.stamps[left] - stamps)
+        right_difference = np.abs(self.stamps[right] - stamps)
+        indices = np.where(right_difference < left_difference, right, left)
+        ties = np.flatnonzero(right_difference == left_difference)
+        if len(ties):
+            indices[ties] = np.where(self._visits_left_first(right[ties]), left[ties], right[ties])
+        return indices
+
+    def _visits_left_first(self, right):
+        """Check which of two neighbouring stamps a binary search visits first.
+        The path of the search only depends on where the value falls, so it
+        can be replayed on the indices alone. The search starts out with the
+        first stamp as its best guess.
+        """
+        beginning = np.zeros(right.shape, dtype=np.intp)
+        end = np.full(right.shape, len(self), dtype=np.intp)
+        left_first = right == 1
+        searching = ~left_first
+        while searching.any():
+            middle = (beginning + end) // 2
+            left_first |= searching & (middle == right - 1)
+            searching &= (middle != right - 1) & (middle != right)
+            end = np.where(searching & (middle > right - 1), middle, end)
+            beginning = np.where(searching & (middle < right), middle + 1, beginning)
+        return left_first
+
+    def associate(self, stamps, offset=0.0, max_difference=np.inf):
+        """Match timestamps to their closest indexed timestamps.
+        Args
+            stamps: Array of timestamps to match.
+            offset: Added to the given timestamps before they are matched.
+            max_difference: The largest time difference of a match.
+
+        Returns
+        -------
+            The index of the closest indexed timestamp to each given one, and
+            a mask of the given timestamps that are within max_difference of it.
+        """
+        indices = self.nearest(stamps, offset)
+        differences = np.abs(self.stamps[indices] - (np.asarray(stamps, dtype=np.float64) + offset))
+        return indices, differences <= max_difference
+
+    def bracket(self, stamps):
+        """Find the indexed timestamps on either side of each of the given ones.
+        Args
+            stamps: Array of timestamps to look up.
+
+        Returns
+        -------
+            The indices of the last indexed timestamp at or before each given
+            one and of the one after it, and the weight of the latter for
+            linear interpolation. Timestamps outside the indexed range are
+            clamped to its ends.
+        """
+        stamps = np.asarray(stamps, dtype=np.float64)
+        right = np.clip(np.searchsorted(self.stamps, stamps, side='right'), 1, max(len(self) - 1, 1))
+        left = np.minimum(right - 1, len(self) - 1)
+        right = np.minimum(right, len(self) - 1)
+        interval = self.stamps[right] - self.stamps[left]
+        weights = np.divide(stamps - self.stamps[left], interval, out=np.zeros(stamps.shape), where=interval > 0)
+        return left, right, np.clip(weights, 0.0, 1.0)
@@ -0,0 +1,61 @@
+"""Transforms module.
+This module converts between the rotation representations used by the
+pipeline. It only needs numpy, so that code that just works with poses
+does not have to import OpenCV or OpenGL.
+"""
+
+import numpy as np
+
+
+def rodrigues(rotation_vector):
+    """Convert a rotation vector to a rotation matrix, like cv2.Rodrigues.
+    Args
+        rotation_vector: The rotation axis scaled by the rotation angle in radians.
+
+    Returns
+    -------
+        The 3x3 rotation matrix.
+    """
+    rotation_vector = np.asarray(rotation_vector, np.float64).reshape(3)
+    theta = np.linalg.norm(rotation_vector)
+    if theta < np.finfo(np.float64).eps:
+        return np.identity(3)
+    x, y, z = rotation_vector / theta
+    cross = np.array(((0, -z, y), (z, 0, -x), (-y, x, 0)))
+    return (np.cos(theta) * np.identity(3) + (1 - np.cos(theta)) * np.outer((x, y, z), (x, y, z))
+            + np.sin(theta) * cross)
+
+def rotation_vector_to_matrix(rotation_vector):
+    rotation_vector = np.array([-rotation_vector[0], -rotation_vector[1], -rotation_vector[2]])
+    rot = rodrigues(rotation_vector)
+    # Make the rotation matrix homogeneous
+    rot = np.concatenate((rot, np.zeros((1, 3))), axis=0)
+    rot = np.concatenate((rot, np.zeros((4, 1))), axis=1)
+    rot[3, 3] = 1
+    return rot
+
+def rotation_vector_to_quaternion(rotation_vector):
+    rotation_vector = np.array([-rotation_vector[0], -rotation_vector[1], -rotation_vector[2]])
+    rot = rodrigues(rotation_vector)
+    return matrix_to_quaternion(rot)
+
+def matrix_to_quaternion(m):
+    if m[2,2] < 0:
+        if m[0,0] > m[1,1]:
+            t = 1 + m[0,0] - m[1,1] - m[2,2]
+            q = (t, m[0,1] + m[1,0], m[2,0] + m[0,2], m[1,2] - m[2,1])
+        else:
+            t = 1 - m[0,0] + m[1,1] - m[2,2]
+            q = (m[0,1] + m[1,0], t, m[1,2] + m[2,1], m[2,0] - m[0,2])
+    else:
+        if m[0,0] < -m[1,1]:
+            t = 1 - m[0,0] - m[1,1] + m[2,2]
+            q = (m[2,0] + m[0,2], m[1,2] + m[2,1], t, m[0,1] - m[1,0])
+        else:
+            t = 1 + m[0,0] + m[1,1] + m[2,2]
+            q = (m[1,2] - m[2,1], m[2,0] - m[0,2], m[0,1] - m[1,0], t)
+
+    q = np.array(q)
+    q *= 0.5 / np.sqrt(t)
+
+    return q